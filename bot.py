@@ -37,7 +37,10 @@ def start():
     load_extensions()
 
     log.info("Starting bot...")
-    bot.run(config_discord.token())
+    try:
+        bot.run(config_discord.token())
+    finally:
+        service_holder.disable_all()
 
 
 @bot.event
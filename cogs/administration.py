@@ -2,7 +2,7 @@ import nextcord
 from nextcord import SlashOption
 from nextcord.ext.commands import Cog, Bot
 
-from core import files, log, ui, magic
+from core import files, log, ui, magic, metrics
 from core.service import services
 
 
@@ -12,7 +12,7 @@ class Control(Cog):
         self.config: files.Config = kwargs["config"]
         self.services: services.Holder = kwargs["services"]
 
-        self.database = self.services.database
+        self.database = self.services.async_database
         self.discord = self.services.discord
 
     @nextcord.slash_command(
@@ -30,8 +30,8 @@ class Control(Cog):
                 max_length=100
             )
     ):
-        has_privileges = self.database.is_premium_user(spigot_name)
-        linked = self.database.is_spigot_name_linked(spigot_name)
+        has_privileges = await self.database.is_premium_user(spigot_name)
+        linked = await self.database.is_spigot_name_linked(spigot_name)
 
         message = f"""Following information has been found about the SpigotMC account '{spigot_name}':
         has_privileges: {has_privileges}
@@ -59,17 +59,20 @@ class Control(Cog):
     ):
         user: nextcord.Member = it.user
 
+        # acknowledged right away, the role update may wait for edit tokens of a running sweep
+        await it.response.defer(ephemeral=True)
+
         target = await self.discord.fetch_member(int(discord_id))
 
         if target is None:
-            await it.response.send_message(
+            await it.followup.send(
                 content=f"This Discord user does not exist. 😕",
                 ephemeral=True
             )
             return
 
-        if not self.database.is_user_linked(target.id):
-            await it.response.send_message(
+        if not await self.database.is_user_linked(target.id):
+            await it.followup.send(
                 content=f"This Discord user is not linked to a SpigotMC account. 😕",
                 ephemeral=True
             )
@@ -77,14 +80,34 @@ class Control(Cog):
 
         log.info(f"The Discord user '{user}' has initiated the link removal of '{target}'.")
 
-        self.database.invalidate_link(target.id)
+        await self.database.invalidate_link(target.id)
         await self.discord.update_member(target)
 
-        await it.response.send_message(
+        await it.followup.send(
             content=f"The verification of '{target}' has been removed. 👀",
             ephemeral=True
         )
 
+    @nextcord.slash_command(
+        name="statistics",
+        description="Shows latency and counter statistics of the bot services.",
+        default_member_permissions=nextcord.Permissions(administrator=True),
+        dm_permission=False
+    )
+    async def statistics(self, it: nextcord.interactions.Interaction):
+        lines = metrics.report()
+        if len(lines) == 0:
+            lines = ["No statistics have been recorded yet."]
+
+        content = "\n".join(lines)
+        if len(content) > 1900:
+            content = content[:1900] + "\n..."
+
+        await it.response.send_message(
+            content=f"```\n{content}\n```",
+            ephemeral=True
+        )
+
     @nextcord.slash_command(
         name="promotion_message",
         description="Posts the promotion message including 'start' button.",
@@ -1,16 +1,17 @@
+import asyncio
 import random
-import threading
+import time
 import traceback
 from datetime import datetime
-from typing import Tuple, Union, Dict
+from typing import Optional, Set
 
 import nextcord
-from nextcord import SlashOption, HTTPException, Message, errors
+from nextcord import SlashOption, HTTPException, errors
 from nextcord.ext import tasks
 from nextcord.ext.commands import Cog, Bot
 
-from core import files, log, ui, magic
-from core.service import services
+from core import files, log, ui, magic, metrics, limits
+from core.service import services, promotions
 
 
 class Promote(Cog):
@@ -19,72 +20,118 @@ class Promote(Cog):
         self.config: files.Config = kwargs["config"]
         self.services: services.Holder = kwargs["services"]
 
-        self.database = self.services.database
+        self.database = self.services.async_database
         self.mail_service = self.services.mail
         self.paypal = self.services.paypal
         self.discord = self.services.discord
 
-        self.sent_codes = {}
-        self.sent_messages = {}
-        self.sent_admin_messages: Dict[int, Message] = {}
-        self.reserved = []
-        self.inbox: dict[str, tuple[str, datetime]] = dict()
+        self.promotions = promotions.PromotionStore(self.config, self.database)
+        self.admission = self.__create_admission__()
+        self.config.add_reload_listener(self.on_config_reload)
+
+    def __create_admission__(self) -> limits.AdmissionControl:
+        config = self.config.discord()
+        return limits.AdmissionControl(
+            "promotions.admission",
+            config.admission_rate(),
+            config.admission_burst(),
+            config.user_admissions_per_minute() / 60,
+            config.user_admission_burst(),
+            config.admission_tracked_users()
+        )
+
+    def on_config_reload(self, previous: files.Snapshot, snapshot: files.Snapshot, changed: Set[str]) -> None:
+        if "discord" in changed:
+            config = snapshot.discord
+            self.admission.reload(
+                config.admission_rate(),
+                config.admission_burst(),
+                config.user_admissions_per_minute() / 60,
+                config.user_admission_burst(),
+                config.admission_tracked_users()
+            )
 
     @Cog.listener()
     async def on_ready(self):
         self.safe_check_inbox.start()
-        self.load_inbox.start()
+        self.sweep_promotions.start()
 
-    @tasks.loop(seconds=5)
-    async def safe_check_inbox(self):
-        try:
-            await self.check_inbox()
-        except Exception as e:
-            log.error("Got an error while checking the inbox:", e, f"\n{traceback.format_exc()}")
+    @tasks.loop(minutes=1)
+    async def sweep_promotions(self):
+        if not self.services.all_services_ready():
+            return
 
-    @tasks.loop(seconds=10)
-    async def load_inbox(self):
         try:
-            inbox_thread = threading.Thread(target=self.get_inbox)
-            inbox_thread.start()
+            await self.promotions.load()
         except Exception as e:
-            log.error("Got an error while loading the inbox:", e, f"\n{traceback.format_exc()}")
+            log.error("Could not restore the pending promotions, retrying with the next sweep:", e)
 
-    def get_inbox(self):
-        self.inbox = self.mail_service.got_received_promotion_keys()
+        for promotion in await self.promotions.expire():
+            log.info(f"Promotion process for {promotion.user_id} expired.")
+            await self.update_interaction(
+                promotion,
+                content="Your promotion has **expired**. Please restart your promotion."
+            )
 
-    async def check_inbox(self):
-        if not self.services.all_services_ready():
-            return
+    @tasks.loop(seconds=0)
+    async def safe_check_inbox(self):
+        # wakes up for every batch of new verification mails instead of polling
+        watcher = self.mail_service.watcher
+        delta = await watcher.deltas.get()
+
+        while not self.services.all_services_ready():
+            await asyncio.sleep(5)
 
-        to_be_removed = []
-        for user_id in self.sent_codes.keys():
-            data = self.sent_codes[user_id]
-            started, key, spigot_name = data
+        try:
+            failed = await self.check_inbox(delta.mails)
+        except Exception as e:
+            log.error("Got an error while checking the inbox:", e, f"\n{traceback.format_exc()}")
+            failed = delta.mails
 
-            match = self.inbox.get(spigot_name.lower())
-            if match is not None:
-                message, date = match
+        if len(failed) == 0:
+            watcher.confirm(delta)
+        else:
+            # the mails are never fetched again, so they stay queued until they are handled or their promotion expired
+            delta.mails = failed
+            asyncio.get_running_loop().call_later(magic.INBOX_RETRY_DELAY, watcher.deltas.put_nowait, delta)
 
-                if date <= started:
-                    continue
+    async def check_inbox(self, mails: dict[str, tuple[str, datetime]]) -> dict[str, tuple[str, datetime]]:
+        # mails may arrive before the first sweep, promotions of the last run have to be restored first
+        await self.promotions.load()
 
-                user = await self.discord.fetch_member(user_id)
-                if str(key) in message:
-                    log.info(f"Promotion process for {user} has been completed.")
-                    await self.promote(user, spigot_name)
-                else:
-                    log.info(f"Promotion process for {user} failed.")
-                    await self.update_interaction(
-                        user,
-                        content=f"This promotion key is **not correct**. Please restart your promotion."
-                    )
+        failed = {}
+        for name, (message, date) in mails.items():
+            try:
+                await self.check_mail(name, message, date)
+            except Exception as e:
+                log.error(f"Got an error while checking the mail of '{name}', retrying later:", e,
+                          f"\n{traceback.format_exc()}")
+                failed[name] = (message, date)
+        return failed
+
+    async def check_mail(self, name: str, message: str, date: datetime) -> None:
+        promotion = self.promotions.by_name(name)
+        if promotion is None or date <= promotion.started:
+            return
 
-                to_be_removed.append(user_id)
-                self.reserved.remove(spigot_name)
+        user = await self.discord.fetch_member(promotion.user_id)
+        if self.promotions.get(promotion.user_id) is not promotion:
+            # restarted or invalidated while the member was fetched
+            return
 
-        for remove in to_be_removed:
-            self.sent_codes.pop(remove)
+        if user is None:
+            await self.promotions.remove(promotion.user_id, promotion)
+            log.info(f"Promotion process for {promotion.user_id} cancelled since the user left the guild.")
+        elif str(promotion.key) in message:
+            await self.promote(user, promotion)
+            log.info(f"Promotion process for {user} has been completed.")
+        else:
+            await self.promotions.remove(promotion.user_id, promotion)
+            log.info(f"Promotion process for {user} failed.")
+            await self.update_interaction(
+                promotion,
+                content=f"This promotion key is **not correct**. Please restart your promotion."
+            )
 
     @nextcord.slash_command(
         name="invalidate_ongoing_promotion",
@@ -113,18 +160,16 @@ class Promote(Cog):
             return
 
         log.info(f"The Discord user '{user}' has invalidated the ongoing promotion process of '{target}'.")
-        _, spigot_name = self.get_cached_promotion_key(target)
+        promotion = await self.promotions.remove(target.id)
 
-        if spigot_name is None:
+        if promotion is None:
             await it.response.send_message(
                 content=f"This Discord user has no ongoing promotion process. 😕",
                 ephemeral=True
             )
             return
 
-        self.reserved.remove(spigot_name)
-
-        await self.update_interaction(target, content="Your promotion has been cancelled.")
+        await self.update_interaction(promotion, content="Your promotion has been cancelled.")
         await it.response.send_message(
             content=f"The promotion process of '{target}' has been invalidated.",
             ephemeral=True
@@ -150,7 +195,22 @@ class Promote(Cog):
             if user_id.isnumeric():
                 await self.conversation_created(it, int(user_id))
 
+    async def reject_overload(self, it: nextcord.Interaction) -> None:
+        await it.response.send_message(
+            embed=nextcord.Embed(
+                color=magic.COLOR_WARNING,
+                title="⏳ Account Promotion",
+                description="Too many promotion requests at the moment. Please wait a minute and try again."
+            ),
+            ephemeral=True
+        )
+
     async def start_promotion(self, it: nextcord.Interaction) -> None:
+        # charged once per attempt, the modal submitted to send_promotion_key is only shown from here
+        if not self.admission.admit(it.user.id):
+            await self.reject_overload(it)
+            return
+
         if not self.services.all_services_ready():
             await it.response.send_message(
                 embed=nextcord.Embed(
@@ -166,26 +226,29 @@ class Promote(Cog):
         await it.response.send_modal(ui.SpigotNameInput(self.send_promotion_key))
 
     async def no_conversation_access(self, it: nextcord.Interaction) -> None:
-        key, _ = self.get_cached_promotion_key(it.user, invalidate=False)
+        promotion = await self.get_promotion(it)
+        if promotion is None:
+            return
 
         await it.response.defer()
         await self.update_interaction(
-            it.user,
-            invalidate=False,
+            promotion,
             content="You can also use an **open conversation** for your verification.\n"
                     "If you don't have one, you can also click on the button below. "
                     "However, this requires to *manually* open the conversation by an admin. This may take a bit.\n"
                     "\n"
-                    f"Your verification code: `{key}`",
+                    f"Your verification code: `{promotion.key}`",
             view=ui.NoAccessToNewConversations()
         )
 
     async def no_open_conversation(self, it: nextcord.Interaction) -> None:
-        key, spigot_name = self.get_cached_promotion_key(it.user, invalidate=False)
+        promotion = await self.get_promotion(it)
+        if promotion is None:
+            return
 
+        key = promotion.key
         await self.update_interaction(
-            it.user,
-            invalidate=False,
+            promotion,
             content="Your request has been forwarded. Please wait, until the conversation is created."
         )
 
@@ -213,9 +276,10 @@ class Promote(Cog):
         if admin_channel is None:
             raise Exception("No admin channel available!")
 
+        # restored promotions only know the hashed spigot name, the admin has to fill in the recipient then
         await admin_channel.send(
             content=admin_message,
-            view=ui.CreateConversationForUser(spigot_name, self.config.spigotmc().topic(), it.user.id)
+            view=ui.CreateConversationForUser(promotion.spigot_name or "", self.config.spigotmc().topic(), it.user.id)
         )
 
         msg = await admin_channel.send(
@@ -227,7 +291,7 @@ class Promote(Cog):
                     f"\n"
                     f"Ignore this message if you haven't requested it."
         )
-        self.sent_admin_messages[it.user.id] = msg
+        promotion.admin_message = msg
 
     async def conversation_created(self, it: nextcord.Interaction, user_id: int) -> None:
         user = self.discord.get_member(user_id)
@@ -250,110 +314,113 @@ class Promote(Cog):
         except errors.Forbidden:
             await it.message.edit(content=f"The user {user} could not be informed about the conversation due to their discord privacy settings.", view=None)
 
-        if user_id in self.sent_admin_messages:
-            await self.sent_admin_messages[user_id].delete()
+        promotion = self.promotions.get(user_id)
+        if promotion is not None and promotion.admin_message is not None:
+            await promotion.admin_message.delete()
+            promotion.admin_message = None
 
     async def send_promotion_key(self, it: nextcord.Interaction, spigot_name: str):
+        started = time.perf_counter()
+
+        # acknowledged right away, the lookups below may take longer than discord's 3 second window
+        await it.response.defer(ephemeral=True)
+        metrics.latency("interactions.send_promotion_key.ack").record(time.perf_counter() - started)
+
+        try:
+            await self.__send_promotion_key__(it, spigot_name)
+        finally:
+            metrics.latency("interactions.send_promotion_key").record(time.perf_counter() - started)
+
+    async def __send_promotion_key__(self, it: nextcord.Interaction, spigot_name: str):
         user: nextcord.Member = it.user
 
-        old_promotion_key, old_spigot_name = self.get_cached_promotion_key(user, False)
-        if old_spigot_name is not None and old_spigot_name in self.reserved:
-            self.reserved.remove(old_spigot_name)
+        old_promotion = await self.promotions.remove(user.id)
+        if old_promotion is not None:
             log.info(f"Promotion process for {user} cancelled.")
-            await self.update_interaction(user, content="This verification process has been cancelled.")
+            await self.update_interaction(old_promotion, content="This verification process has been cancelled.")
 
-        if spigot_name in self.reserved:
-            await it.response.send_message(
+        if self.promotions.is_reserved(spigot_name):
+            await it.followup.send(
                 content=f"This SpigotMC account is already linked to a Discord account. 😕", ephemeral=True)
             return
 
-        if self.database.is_user_linked(user.id):
+        if await self.database.is_user_linked(user.id):
             if await self.discord.update_member(user):
-                await it.response.send_message(
+                await it.followup.send(
                     content=f"Your Discord roles have been updated. 😏", ephemeral=True)
             else:
-                await it.response.send_message(
+                await it.followup.send(
                     content=f"Your Discord account is already linked to a SpigotMC account. 🥸", ephemeral=True)
             return
 
-        if self.database.is_spigot_name_linked(spigot_name):
-            await it.response.send_message(
+        if await self.database.is_spigot_name_linked(spigot_name):
+            await it.followup.send(
                 content=f"This SpigotMC account is already linked to a Discord account. 😕", ephemeral=True)
             return
 
-        # update transactions before trying to find a match
-        self.paypal.update_transaction_data()
-
-        if self.database.is_premium_user(spigot_name):
-            log.info(f"Starting promotion process for {user}.")
+        premium = await self.database.is_premium_user(spigot_name)
+        if not premium:
+            # only a miss waits for the newest transactions, shared with every other caller
+            await self.paypal.refresh()
+            premium = await self.database.is_premium_user(spigot_name)
 
-            promotion_key = self.generate_promotion_key(user, spigot_name)
-            self.reserved.append(spigot_name)
-
-            spigot_config = self.config.spigotmc()
-
-            pim: nextcord.PartialInteractionMessage = await it.response.send_message(
-                content=f"Please verify the promotion key by sending it to us in a conversation on "
-                        f"SpigotMc.\n"
-                        f"\n"
-                        f"1. Copy the key: `{promotion_key}`\n"
-                        f"2. Click the button below to create a conversation\n"
-                        f"3. Paste the code in the text area and submit",
-                view=ui.ConversationStartButtons(spigot_config.recipient(), spigot_config.topic()),
-                ephemeral=True
-            )
-            self.sent_messages[user.id] = pim
-        else:
+        if not premium:
             log.info(f"Failed transaction id lookup for {user}.")
-            await it.response.send_message(
+            await it.followup.send(
                 content=f"We could not find any purchase linked to your account. 😕",
                 ephemeral=True
             )
+            return
+
+        if self.promotions.is_reserved(spigot_name):
+            # reserved by someone else while waiting for the lookups
+            await it.followup.send(
+                content=f"This SpigotMC account is already linked to a Discord account. 😕", ephemeral=True)
+            return
+
+        log.info(f"Starting promotion process for {user}.")
+        promotion = await self.promotions.add(user.id, spigot_name, random.randint(100000, 999999))
+
+        spigot_config = self.config.spigotmc()
+        promotion.message = await it.followup.send(
+            content=f"Please verify the promotion key by sending it to us in a conversation on "
+                    f"SpigotMc.\n"
+                    f"\n"
+                    f"1. Copy the key: `{promotion.key}`\n"
+                    f"2. Click the button below to create a conversation\n"
+                    f"3. Paste the code in the text area and submit",
+            view=ui.ConversationStartButtons(spigot_config.recipient(), spigot_config.topic()),
+            ephemeral=True
+        )
 
-    async def promote(self, user: nextcord.Member, spigot_name: str) -> None:
-        self.database.link_user(user.id, spigot_name)
+    async def promote(self, user: nextcord.Member, promotion: promotions.PendingPromotion) -> None:
+        await self.database.link_user(user.id, promotion.name, do_hash=False)
+        # only finished once the link exists, a failing link keeps the promotion for the retry
+        await self.promotions.remove(user.id, promotion)
         await self.discord.update_member(user)
         await self.update_interaction(
-            user,
+            promotion,
             content=self.config.discord().promotion_message().format(user=user.mention)
         )
 
-    async def update_interaction(self, user: nextcord.Member, invalidate: bool = True, content: str = None,
+    async def update_interaction(self, promotion: promotions.PendingPromotion, content: str = None,
                                  view: nextcord.ui.View = None) -> None:
-        plm: nextcord.PartialInteractionMessage = self.sent_messages.get(user.id)
-        if plm:
+        message = promotion.message
+        if message:
             try:
-                await plm.edit(content=content, view=view)
+                await message.edit(content=content, view=view)
             except HTTPException as h:
                 log.warning(f"Could not update interaction due to an HTTPException. "
-                            f"User={user}, invalidate={invalidate}, content='{content}'; Error: {h}")
-
-        if invalidate:
-            self.sent_messages.pop(user.id)
+                            f"User={promotion.user_id}, content='{content}'; Error: {h}")
 
-    def generate_promotion_key(self, user: nextcord.Member, spigot_name: str) -> int:
-        started_at = datetime.now()
-        key = random.randint(100000, 999999)
-        self.sent_codes[user.id] = (started_at, key, spigot_name)
-        return key
-
-    def get_cached_promotion_key(
-            self,
-            user: nextcord.Member,
-            invalidate: bool = True
-    ) -> Union[Tuple[int, str] | Tuple[None, None]]:
-        cache: Tuple[datetime, int, str] = self.sent_codes.get(user.id)
-
-        if cache is None:
-            # no key found
-            return None, None
-
-        started_at, key, spigot_name = cache
-
-        if invalidate:
-            self.sent_codes.pop(user.id)
-
-        return key, spigot_name
+    async def get_promotion(self, it: nextcord.Interaction) -> Optional[promotions.PendingPromotion]:
+        promotion = self.promotions.get(it.user.id)
+        if promotion is None:
+            await it.response.send_message(
+                content="Your promotion has **expired**. Please restart your promotion.",
+                ephemeral=True
+            )
+        return promotion
 
 
 def setup(bot: Bot, **kwargs):
@@ -1,8 +1,13 @@
+import asyncio
+import time
+from typing import Optional, Set
+
+import nextcord
 from nextcord.ext import tasks
 from nextcord.ext.commands import Cog, Bot
 
 from core import files, log
-from core.service import services
+from core.service import services, discord_utils
 
 
 class Scheduler(Cog):
@@ -12,25 +17,79 @@ class Scheduler(Cog):
         self.services: services.Holder = kwargs["services"]
 
         self.paypal = self.services.paypal
-        self.stripe = self.services.stripe
         self.discord = self.services.discord
 
+        self.last_full_sweep: Optional[float] = None
+        self.config.add_reload_listener(self.on_config_reload)
+
+    def on_config_reload(self, previous: files.Snapshot, snapshot: files.Snapshot, changed: Set[str]) -> None:
+        log.info(f"Reloaded config sections: {', '.join(sorted(changed))}")
+
+        if "discord" in changed and discord_utils.roles_changed(previous.discord, snapshot.discord):
+            # members might own resources which are mapped to other roles now
+            self.last_full_sweep = None
+
     @Cog.listener()
     async def on_ready(self):
         self.start_role_updater.start()
+        self.watch_config.start()
+
+    @Cog.listener()
+    async def on_member_join(self, member: nextcord.Member):
+        # restores the roles of linked buyers who rejoin
+        self.discord.request_update(member.id)
+
+    @Cog.listener()
+    async def on_member_update(self, before: nextcord.Member, after: nextcord.Member):
+        changed = set(before.roles).symmetric_difference(after.roles)
+        if any(self.discord.is_managed_role(r) for r in changed):
+            self.discord.request_update(after.id)
+
+    @Cog.listener()
+    async def on_guild_role_create(self, role: nextcord.Role):
+        if role.guild.id == self.config.discord().guild_id():
+            self.discord.registry.update(role)
+
+    @Cog.listener()
+    async def on_guild_role_update(self, before: nextcord.Role, after: nextcord.Role):
+        if after.guild.id == self.config.discord().guild_id():
+            self.discord.registry.update(after)
+
+    @Cog.listener()
+    async def on_guild_role_delete(self, role: nextcord.Role):
+        if role.guild.id == self.config.discord().guild_id():
+            self.discord.registry.remove(role)
 
     @tasks.loop(minutes=5)
     async def start_role_updater(self):
         if not self.services.all_services_ready():
             return
 
-        self.paypal.update_transaction_data(silent=True)
-        if self.stripe:
-            self.stripe.update(silent=True)
+        # shares the sync with promotions that refresh at the same time instead of blocking the loop on its lock
+        await self.paypal.refresh()
+        if self.services.stripe:
+            await asyncio.to_thread(self.services.stripe.update, True)
+
+        sweep_interval = self.config.discord().full_sweep_interval() * 60
+        if self.last_full_sweep is None or time.monotonic() - self.last_full_sweep >= sweep_interval:
+            # safety net for changes that never marked a member as dirty, covers the dirty ones as well
+            self.last_full_sweep = time.monotonic()
+            report = await self.discord.update_members()
+            log.info(f"Full role reconciliation finished: {report}")
+        else:
+            report = await self.discord.update_dirty_members()
+            if report.total > 0:
+                log.info(f"Incremental role reconciliation finished: {report}")
+
+    @tasks.loop(seconds=5)
+    async def watch_config(self):
+        if not self.config.has_changed():
+            return
 
-        changed = await self.discord.update_members()
-        if changed > 0:
-            log.info(f"Updated {changed} member(s) automatically.")
+        try:
+            await self.config.reload()
+        except (OSError, ValueError, files.ConfigError) as e:
+            log.error("Could not reload your config, the previous one stays active:", e)
 
 
 def setup(bot: Bot, **kwargs):
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, TypeVar, Optional, Callable, Hashable, Tuple, Awaitable
+
+from core import metrics
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    def __init__(self, name: str, capacity: int, on_evict: Optional[Callable[[K, V], None]] = None):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.on_evict = on_evict
+
+        self.entries: OrderedDict[K, V] = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = metrics.counter(f"{name}.hits")
+        self.misses = metrics.counter(f"{name}.misses")
+
+    def get(self, key: K) -> Optional[V]:
+        with self.lock:
+            if key not in self.entries:
+                self.misses.increment()
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits.increment()
+            return self.entries[key]
+
+    def peek(self, key: K) -> Optional[V]:
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key: K, value: V) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.capacity:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                if self.on_evict:
+                    self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key: K) -> Optional[V]:
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key: K) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+
+class TTLCache(LRUCache[K, Tuple[float, V]]):
+    def __init__(self, name: str, capacity: int, ttl: float):
+        super().__init__(name, capacity)
+        self.ttl = ttl
+
+    def lookup(self, key: K) -> Tuple[bool, Optional[V]]:
+        # returns whether a valid entry was found, since None can be a cached value as well
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self.entries.pop(key)
+                self.misses.increment()
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits.increment()
+            return True, entry[1]
+
+    def store(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        self.put(key, (time.monotonic() + (self.ttl if ttl is None else ttl), value))
+
+
+class SingleFlight(Generic[K, V]):
+    def __init__(self):
+        self.flights: dict[K, asyncio.Future] = {}
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.flights
+
+    async def run(self, key: K, call: Callable[[], Awaitable[V]]) -> V:
+        # concurrent callers of the same key share a single call instead of starting their own
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(call())
+            self.flights[key] = future
+            future.add_done_callback(lambda _: self.flights.pop(key, None))
+
+        # a cancelled caller must not cancel the call the other callers are waiting for
+        return await asyncio.shield(future)
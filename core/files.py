@@ -1,9 +1,18 @@
+import asyncio
 import json
 import os
-from typing import Optional
+from datetime import datetime
+from types import MappingProxyType
+from typing import Optional, Any, Mapping, Callable, List, Set, Tuple
 
 import nextcord
 
+MISSING = object()
+
+
+class ConfigError(Exception):
+    pass
+
 
 def read_file(file: str) -> Optional[str]:
     if not os.path.exists(file):
@@ -35,26 +44,160 @@ class File:
             json.dump(self.file, f, indent=2)
 
 
-class Wrapper:
-    def __init__(self, file: dict, sub: str):
-        self.file = file[sub]
-        
+def __lookup__(values: dict, path: str, key: str, default: Any = MISSING) -> Any:
+    if key in values and values[key] is not None:
+        return values[key]
+
+    if default is MISSING:
+        raise ConfigError(f"Missing config value '{path}.{key}'.")
+    return default
+
+
+def __section__(values: dict, path: str, key: str, optional: bool = False) -> dict:
+    section = __lookup__(values, path, key, {} if optional else MISSING)
+    if not isinstance(section, dict):
+        raise ConfigError(f"Config value '{path}.{key}' must be an object, got {type(section).__name__}.")
+    return section
+
+
+def __text__(values: dict, path: str, key: str, default: Any = MISSING) -> str:
+    value = __lookup__(values, path, key, default)
+    if not isinstance(value, str):
+        raise ConfigError(f"Config value '{path}.{key}' must be a string, got {value!r}.")
+    return value
+
+
+def __flag__(values: dict, path: str, key: str, default: Any = MISSING) -> bool:
+    value = __lookup__(values, path, key, default)
+    if not isinstance(value, bool):
+        raise ConfigError(f"Config value '{path}.{key}' must be true or false, got {value!r}.")
+    return value
+
+
+def __integer__(values: dict, path: str, key: str, default: Any = MISSING, minimum: Optional[int] = None) -> int:
+    value = __lookup__(values, path, key, default)
+    if isinstance(value, bool):
+        raise ConfigError(f"Config value '{path}.{key}' must be an integer, got {value!r}.")
+
+    try:
+        result = int(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f"Config value '{path}.{key}' must be an integer, got {value!r}.")
+
+    if minimum is not None and result < minimum:
+        raise ConfigError(f"Config value '{path}.{key}' must be at least {minimum}, got {result}.")
+    return result
+
+
+def __number__(values: dict, path: str, key: str, default: Any = MISSING, minimum: Optional[float] = None) -> float:
+    value = __lookup__(values, path, key, default)
+    if isinstance(value, bool):
+        raise ConfigError(f"Config value '{path}.{key}' must be a number, got {value!r}.")
+
+    try:
+        result = float(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f"Config value '{path}.{key}' must be a number, got {value!r}.")
+
+    if minimum is not None and result < minimum:
+        raise ConfigError(f"Config value '{path}.{key}' must be at least {minimum}, got {result}.")
+    return result
+
+
+class Section:
+    __slots__ = ()
+
+    def __assign__(self, **values) -> None:
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is an immutable config snapshot.")
+
+    def __delattr__(self, key: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is an immutable config snapshot.")
+
+
+class Discord(Section):
+    __slots__ = ("__token__", "__guild_id__", "__activity__", "__activity_type__", "__premium_role__", "__roles__",
+                 "__role_by_rid__", "__rid_by_role__", "__resource_ids__", "__resource_roles__",
+                 "__reconciliation_concurrency__", "__role_edit_rate__", "__role_edit_burst__",
+                 "__full_sweep_interval__", "__event_delay__", "__member_cache_size__", "__member_cache_ttl__",
+                 "__member_cache_negative_ttl__", "__pending_promotion_ttl__", "__max_pending_promotions__",
+                 "__persist_pending_promotions__", "__admission_rate__", "__admission_burst__",
+                 "__user_admission_rate__", "__user_admission_burst__", "__admission_tracked_users__",
+                 "__promotion_message__", "__promotion_start_title__",
+                 "__promotion_start_content__", "__spigot_author_id__", "__admin_channel__")
 
-class Discord(Wrapper):
     def __init__(self, file: dict):
-        super().__init__(file, "discord")
+        path = "discord"
+        values = __section__(file, "config", path)
+        reconciliation = __section__(values, path, "reconciliation", optional=True)
+        member_cache = __section__(values, path, "member_cache", optional=True)
+        pending_promotions = __section__(values, path, "pending_promotions", optional=True)
+        admission = __section__(values, path, "admission", optional=True)
+        promotion_start = __section__(values, path, "promotion_start")
+
+        functional_roles = __section__(values, path, "functional_roles")
+        role_by_rid = {}
+        for key in functional_roles.keys():
+            try:
+                rid = int(key)
+            except ValueError:
+                raise ConfigError(f"Resource id '{key}' in '{path}.functional_roles' must be an integer.")
+            role_by_rid[rid] = __integer__(functional_roles, f"{path}.functional_roles", key)
+
+        rid_by_role = {role_id: rid for rid, role_id in role_by_rid.items()}
+        if len(rid_by_role) != len(role_by_rid):
+            raise ConfigError(f"Every resource in '{path}.functional_roles' needs its own role.")
+
+        self.__assign__(
+            __token__=__text__(values, path, "token"),
+            __guild_id__=__integer__(values, path, "guild_id"),
+            __activity__=__text__(values, path, "activity", ""),
+            __activity_type__=__integer__(values, path, "activity_type", -1),
+            __premium_role__=__integer__(values, path, "premium_role"),
+            __roles__=MappingProxyType({str(rid): role_id for rid, role_id in role_by_rid.items()}),
+            __role_by_rid__=MappingProxyType(role_by_rid),
+            __rid_by_role__=MappingProxyType(rid_by_role),
+            __resource_ids__=tuple(role_by_rid.keys()),
+            __resource_roles__=tuple(role_by_rid.values()),
+            __reconciliation_concurrency__=__integer__(reconciliation, f"{path}.reconciliation", "concurrency", 5, 1),
+            __role_edit_rate__=__number__(reconciliation, f"{path}.reconciliation", "edits_per_second", 1, 0.01),
+            __role_edit_burst__=__integer__(reconciliation, f"{path}.reconciliation", "edit_burst", 10, 1),
+            __full_sweep_interval__=__number__(reconciliation, f"{path}.reconciliation", "full_sweep_interval", 60, 0),
+            __event_delay__=__number__(reconciliation, f"{path}.reconciliation", "event_delay", 3, 0),
+            __member_cache_size__=__integer__(member_cache, f"{path}.member_cache", "size", 1000, 1),
+            __member_cache_ttl__=__number__(member_cache, f"{path}.member_cache", "ttl", 60, 0),
+            __member_cache_negative_ttl__=__number__(member_cache, f"{path}.member_cache", "negative_ttl", 30, 0),
+            __pending_promotion_ttl__=__number__(pending_promotions, f"{path}.pending_promotions", "ttl", 3600, 1),
+            __max_pending_promotions__=__integer__(pending_promotions, f"{path}.pending_promotions", "max_size",
+                                                   1000, 1),
+            __persist_pending_promotions__=__flag__(pending_promotions, f"{path}.pending_promotions", "persist",
+                                                    True),
+            __admission_rate__=__number__(admission, f"{path}.admission", "global_per_second", 5, 0.01),
+            __admission_burst__=__integer__(admission, f"{path}.admission", "global_burst", 30, 1),
+            __user_admission_rate__=__number__(admission, f"{path}.admission", "user_per_minute", 6, 0.01),
+            __user_admission_burst__=__integer__(admission, f"{path}.admission", "user_burst", 6, 1),
+            __admission_tracked_users__=__integer__(admission, f"{path}.admission", "tracked_users", 10000, 1),
+            __promotion_message__=__text__(values, path, "promotion_message"),
+            __promotion_start_title__=__text__(promotion_start, f"{path}.promotion_start", "title"),
+            __promotion_start_content__=__text__(promotion_start, f"{path}.promotion_start", "content"),
+            __spigot_author_id__=__integer__(values, path, "spigot_author_id"),
+            __admin_channel__=__integer__(values, path, "admin_channel")
+        )
 
     def token(self) -> str:
-        return self.file["token"]
+        return self.__token__
 
     def guild_id(self) -> int:
-        return int(self.file["guild_id"])
+        return self.__guild_id__
 
     def activity(self) -> str:
-        return self.file["activity"]
+        return self.__activity__
 
     def activity_type(self) -> int:
-        return int(self.file["activity_type"])
+        return self.__activity_type__
 
     def get_activity(self) -> Optional[nextcord.Activity]:
         if self.activity_type() >= 0:
@@ -63,155 +206,398 @@ class Discord(Wrapper):
             return None
 
     def premium_role(self) -> int:
-        return self.file["premium_role"]
+        return self.__premium_role__
 
-    def roles(self) -> dict:
-        return self.file["functional_roles"]
+    def roles(self) -> Mapping[str, int]:
+        return self.__roles__
 
-    def resource_ids(self) -> list[int]:
-        roles: dict = self.roles()
-        rids = []
-        for sId in roles.keys():
-            rids.append(int(sId))
-        return rids
+    def resource_ids(self) -> tuple[int, ...]:
+        return self.__resource_ids__
 
-    def resource_roles(self) -> list[int]:
-        roles = []
-        for sId in self.roles().values():
-            roles.append(int(sId))
-        return roles
+    def resource_roles(self) -> tuple[int, ...]:
+        return self.__resource_roles__
 
     def role_by_rid(self, rid: int) -> int:
-        return self.roles()[str(rid)]
+        return self.__role_by_rid__[rid]
 
     def rid_by_role(self, role_id: int) -> Optional[int]:
-        roles = self.roles()
+        return self.__rid_by_role__.get(role_id)
 
-        for key in roles.keys():
-            if roles[key] == role_id:
-                return int(key)
-        return None
+    def reconciliation_concurrency(self) -> int:
+        return self.__reconciliation_concurrency__
+
+    def role_edit_rate(self) -> float:
+        return self.__role_edit_rate__
+
+    def role_edit_burst(self) -> int:
+        return self.__role_edit_burst__
+
+    def full_sweep_interval(self) -> float:
+        return self.__full_sweep_interval__
+
+    def event_delay(self) -> float:
+        return self.__event_delay__
+
+    def member_cache_size(self) -> int:
+        return self.__member_cache_size__
+
+    def member_cache_ttl(self) -> float:
+        return self.__member_cache_ttl__
+
+    def member_cache_negative_ttl(self) -> float:
+        return self.__member_cache_negative_ttl__
+
+    def pending_promotion_ttl(self) -> float:
+        return self.__pending_promotion_ttl__
+
+    def max_pending_promotions(self) -> int:
+        return self.__max_pending_promotions__
+
+    def persist_pending_promotions(self) -> bool:
+        return self.__persist_pending_promotions__
+
+    def admission_rate(self) -> float:
+        return self.__admission_rate__
+
+    def admission_burst(self) -> int:
+        return self.__admission_burst__
+
+    def user_admissions_per_minute(self) -> float:
+        return self.__user_admission_rate__
+
+    def user_admission_burst(self) -> int:
+        return self.__user_admission_burst__
+
+    def admission_tracked_users(self) -> int:
+        return self.__admission_tracked_users__
 
     def promotion_message(self) -> str:
-        return self.file["promotion_message"]
+        return self.__promotion_message__
 
     def promotion_start_title(self) -> str:
-        return self.file["promotion_start"]["title"]
+        return self.__promotion_start_title__
 
     def promotion_start_content(self) -> str:
-        return self.file["promotion_start"]["content"]
+        return self.__promotion_start_content__
 
     def spigot_author_id(self) -> int:
-        return int(self.file["spigot_author_id"])
+        return self.__spigot_author_id__
 
     def admin_channel(self) -> int:
-        return int(self.file["admin_channel"])
+        return self.__admin_channel__
+
 
+class EmailService(Section):
+    __slots__ = ("__email__", "__password__", "__host__", "__port__", "__subject__", "__sender_name__",
+                 "__idle_timeout__", "__poll_interval__", "__max_reconnect_delay__", "__socket_timeout__")
 
-class EmailService(Wrapper):
     def __init__(self, file: dict):
-        super().__init__(file, "email_service")
+        path = "email_service"
+        values = __section__(file, "config", path)
+        inbox = __section__(values, path, "inbox", optional=True)
+
+        self.__assign__(
+            __email__=__text__(values, path, "email"),
+            __password__=__text__(values, path, "password"),
+            __host__=__text__(values, path, "host"),
+            __port__=__integer__(values, path, "port", 0, 0),
+            __subject__=__text__(values, path, "subject"),
+            __sender_name__=__text__(values, path, "sender_name"),
+            __idle_timeout__=__number__(inbox, f"{path}.inbox", "idle_timeout", 300, 1),
+            __poll_interval__=__number__(inbox, f"{path}.inbox", "poll_interval", 10, 1),
+            __max_reconnect_delay__=__number__(inbox, f"{path}.inbox", "max_reconnect_delay", 300, 1),
+            __socket_timeout__=__number__(inbox, f"{path}.inbox", "socket_timeout", 60, 1)
+        )
 
     def email(self) -> str:
-        return self.file["email"]
+        return self.__email__
 
     def password(self) -> str:
-        return self.file["password"]
+        return self.__password__
 
     def host(self) -> str:
-        return self.file["host"]
+        return self.__host__
 
     def port(self) -> int:
-        port = self.file["port"]
-        return 0 if port is None else int(port)
+        return self.__port__
 
     def subject(self) -> str:
-        return self.file["subject"]
+        return self.__subject__
 
     def sender_name(self) -> str:
-        return self.file["sender_name"]
-        
+        return self.__sender_name__
+
+    def idle_timeout(self) -> float:
+        return self.__idle_timeout__
+
+    def poll_interval(self) -> float:
+        return self.__poll_interval__
+
+    def max_reconnect_delay(self) -> float:
+        return self.__max_reconnect_delay__
+
+    def socket_timeout(self) -> float:
+        return self.__socket_timeout__
+
+
+class PayPal(Section):
+    __slots__ = ("__client_id__", "__secret__", "__begin_date__")
 
-class PayPal(Wrapper):
     def __init__(self, file: dict):
-        super().__init__(file, "paypal")
+        path = "paypal"
+        values = __section__(file, "config", path)
+
+        begin_date = __text__(values, path, "begin_date")
+        try:
+            datetime.fromisoformat(begin_date.replace("Z", "+00:00"))
+        except ValueError:
+            raise ConfigError(f"Config value '{path}.begin_date' must be a date like "
+                              f"2021-01-01T00:00:00Z, got {begin_date!r}.")
+
+        self.__assign__(
+            __client_id__=__text__(values, path, "client_id"),
+            __secret__=__text__(values, path, "secret"),
+            __begin_date__=begin_date
+        )
 
     def client_id(self) -> str:
-        return self.file["client_id"]
+        return self.__client_id__
 
     def secret(self) -> str:
-        return self.file["secret"]
+        return self.__secret__
 
     def begin_date(self) -> str:
-        return self.file["begin_date"]
+        return self.__begin_date__
+
 
+class Stripe(Section):
+    __slots__ = ("__enabled__", "__custom_field__", "__secret__", "__payment_links__")
 
-class Stripe(Wrapper):
     def __init__(self, file: dict):
-        super().__init__(file, "stripe")
+        path = "stripe"
+        values = __section__(file, "config", path, optional=True)
+        enabled = __flag__(values, path, "enabled", False)
+
+        links = __section__(values, path, "payment_links", optional=not enabled)
+        payment_links = {url: str(__integer__(links, f"{path}.payment_links", url)) for url in links.keys()}
+
+        self.__assign__(
+            __enabled__=enabled,
+            __custom_field__=__text__(values, path, "custom_field", MISSING if enabled else ""),
+            __secret__=__text__(values, path, "secret", MISSING if enabled else ""),
+            __payment_links__=MappingProxyType(payment_links)
+        )
 
     def enabled(self) -> bool:
-        return self.file["enabled"]
+        return self.__enabled__
 
     def custom_field(self) -> str:
-        return self.file["custom_field"]
+        return self.__custom_field__
 
     def secret(self) -> str:
-        return self.file["secret"]
+        return self.__secret__
+
+    def payment_links(self) -> Mapping[str, str]:
+        return self.__payment_links__
+
 
-    def payment_links(self) -> dict:
-        return self.file["payment_links"]
-        
+class Database(Section):
+    __slots__ = ("__backend__", "__file_name__", "__database__", "__user__", "__password__", "__host__", "__port__",
+                 "__pool_size__", "__pool_timeout__", "__pool_health_check_after__", "__queue_size__",
+                 "__slow_query__", "__insert_chunk_size__", "__lookup_chunk_size__", "__entitlement_cache_size__",
+                 "__settings_flush_delay__", "__replicas__", "__replica_lag__")
 
-class Database(Wrapper):
     def __init__(self, file: dict):
-        super().__init__(file, "database")
+        path = "database"
+        values = __section__(file, "config", path)
+
+        backend = __text__(values, path, "backend", "mysql")
+        if backend not in ("mysql", "sqlite"):
+            raise ConfigError(f"Unknown database backend '{backend}'. Use 'mysql' or 'sqlite'.")
+
+        replicas = __lookup__(values, path, "replicas", [])
+        if not isinstance(replicas, list) or not all(isinstance(r, dict) for r in replicas):
+            raise ConfigError(f"Config value '{path}.replicas' must be a list of objects.")
+
+        mysql = backend == "mysql"
+        self.__assign__(
+            __backend__=backend,
+            __file_name__=__text__(values, path, "file", "bot.db"),
+            __database__=__text__(values, path, "database", MISSING if mysql else ""),
+            __user__=__text__(values, path, "user", MISSING if mysql else ""),
+            __password__=__text__(values, path, "password", ""),
+            __host__=__text__(values, path, "host", MISSING if mysql else ""),
+            __port__=__integer__(values, path, "port", 3306, 0),
+            __pool_size__=__integer__(values, path, "pool_size", 5, 1),
+            __pool_timeout__=__number__(values, path, "pool_timeout", 10, 0),
+            __pool_health_check_after__=__number__(values, path, "pool_health_check_after", 30, 0),
+            __queue_size__=__integer__(values, path, "queue_size", 100, 0),
+            __slow_query__=__number__(values, path, "slow_query", 0.5, 0),
+            __insert_chunk_size__=__integer__(values, path, "insert_chunk_size", 500, 1),
+            __lookup_chunk_size__=__integer__(values, path, "lookup_chunk_size", 1000, 1),
+            __entitlement_cache_size__=__integer__(values, path, "entitlement_cache_size", 10000, 1),
+            __settings_flush_delay__=__number__(values, path, "settings_flush_delay", 2, 0),
+            __replicas__=tuple(MappingProxyType(dict(r)) for r in replicas),
+            __replica_lag__=__number__(values, path, "replica_lag", 5, 0)
+        )
+
+    def backend(self) -> str:
+        return self.__backend__
+
+    def file_name(self) -> str:
+        return self.__file_name__
 
     def database(self) -> str:
-        return self.file["database"]
+        return self.__database__
 
     def user(self) -> str:
-        return self.file["user"]
+        return self.__user__
 
     def password(self) -> str:
-        return self.file["password"]
+        return self.__password__
 
     def host(self) -> str:
-        return self.file["host"]
+        return self.__host__
 
     def port(self) -> int:
-        return int(self.file["port"])
+        return self.__port__
+
+    def pool_size(self) -> int:
+        return self.__pool_size__
+
+    def pool_timeout(self) -> float:
+        return self.__pool_timeout__
 
+    def pool_health_check_after(self) -> float:
+        return self.__pool_health_check_after__
+
+    def queue_size(self) -> int:
+        return self.__queue_size__
+
+    def slow_query(self) -> float:
+        return self.__slow_query__
+
+    def insert_chunk_size(self) -> int:
+        return self.__insert_chunk_size__
+
+    def lookup_chunk_size(self) -> int:
+        return self.__lookup_chunk_size__
+
+    def entitlement_cache_size(self) -> int:
+        return self.__entitlement_cache_size__
+
+    def settings_flush_delay(self) -> float:
+        return self.__settings_flush_delay__
+
+    def replicas(self) -> tuple[Mapping[str, Any], ...]:
+        return self.__replicas__
+
+    def replica_lag(self) -> float:
+        return self.__replica_lag__
+
+
+class SpigotMc(Section):
+    __slots__ = ("__recipient__", "__topic__")
 
-class SpigotMc(Wrapper):
     def __init__(self, file: dict):
-        super().__init__(file, "spigotmc")
+        path = "spigotmc"
+        values = __section__(file, "config", path)
+
+        self.__assign__(
+            __recipient__=__text__(values, path, "recipient"),
+            __topic__=__text__(values, path, "topic")
+        )
 
     def recipient(self) -> str:
-        return self.file["recipient"]
+        return self.__recipient__
 
     def topic(self) -> str:
-        return self.file["topic"]
+        return self.__topic__
+
+
+class Snapshot(Section):
+    __slots__ = ("discord", "email_service", "paypal", "stripe", "database", "spigotmc")
+
+    def __init__(self, file: dict):
+        self.__assign__(
+            discord=Discord(file),
+            email_service=EmailService(file),
+            paypal=PayPal(file),
+            stripe=Stripe(file),
+            database=Database(file),
+            spigotmc=SpigotMc(file)
+        )
+
+
+ReloadListener = Callable[[Snapshot, Snapshot, Set[str]], None]
 
 
 class Config(File):
     def __init__(self):
+        self.snapshot: Optional[Snapshot] = None
+        self.modified_at: Optional[int] = None
+        self.reload_listeners: List[ReloadListener] = []
         super(Config, self).__init__("config")
-        
+
+    def load(self) -> None:
+        self.modified_at = self.__modified_at__()
+        super().load()
+        self.snapshot = Snapshot(self.file)
+
+    def __modified_at__(self) -> Optional[int]:
+        try:
+            return os.stat(f"{self.file_name}.json").st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def __read__(self) -> Tuple[dict, Snapshot]:
+        # parses and validates without touching the active snapshot
+        file = File(self.file_name).file
+        return file, Snapshot(file)
+
+    def add_reload_listener(self, listener: ReloadListener) -> None:
+        self.reload_listeners.append(listener)
+
+    def has_changed(self) -> bool:
+        return self.__modified_at__() != self.modified_at
+
+    async def reload(self) -> Set[str]:
+        # taken before reading, so a write during the reload is picked up by the next check
+        modified_at = self.__modified_at__()
+
+        try:
+            file, snapshot = await asyncio.to_thread(self.__read__)
+        except (OSError, ValueError, ConfigError):
+            # keeps the current snapshot and waits for the next change of the file
+            self.modified_at = modified_at
+            raise
+
+        changed = {name for name in Snapshot.__slots__ if file.get(name) != self.file.get(name)}
+        previous = self.snapshot
+
+        self.file = file
+        self.snapshot = snapshot
+        self.modified_at = modified_at
+
+        if len(changed) > 0:
+            for listener in self.reload_listeners:
+                listener(previous, snapshot, changed)
+        return changed
+
     def discord(self) -> Discord:
-        return Discord(self.file)
-        
+        return self.snapshot.discord
+
     def email_service(self) -> EmailService:
-        return EmailService(self.file)
-        
+        return self.snapshot.email_service
+
     def paypal(self) -> PayPal:
-        return PayPal(self.file)
+        return self.snapshot.paypal
 
     def stripe(self) -> Stripe:
-        return Stripe(self.file)
-        
+        return self.snapshot.stripe
+
     def database(self) -> Database:
-        return Database(self.file)
+        return self.snapshot.database
 
     def spigotmc(self) -> SpigotMc:
-        return SpigotMc(self.file)
+        return self.snapshot.spigotmc
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+
+from core import metrics
+from core.cache import LRUCache
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __refill__(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self.lock:
+            self.__refill__(time.monotonic())
+            if self.tokens < tokens:
+                return False
+
+            self.tokens -= tokens
+            return True
+
+    def reserve(self, tokens: float = 1) -> float:
+        # takes the tokens right away and returns how long the caller has to wait until they are covered
+        with self.lock:
+            self.__refill__(time.monotonic())
+            self.tokens -= tokens
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self, tokens: float = 1) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AdmissionControl:
+    def __init__(self, name: str, rate: float, burst: float, user_rate: float, user_burst: float, max_users: int):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+
+        self.bucket = TokenBucket(rate, burst)
+        # forgetting an idle user only resets their budget to a full bucket
+        self.users: LRUCache[int, TokenBucket] = LRUCache(f"{name}.users", max_users)
+
+        self.admitted = metrics.counter(f"{name}.admitted")
+        self.shed_user = metrics.counter(f"{name}.shed.user")
+        self.shed_global = metrics.counter(f"{name}.shed.global")
+
+    def reload(self, rate: float, burst: float, user_rate: float, user_burst: float, max_users: int) -> None:
+        # keeps the budgets users have already spent, a config edit must not let them retry right away
+        self.bucket.rate = rate
+        self.bucket.capacity = burst
+
+        with self.users.lock:
+            self.user_rate = user_rate
+            self.user_burst = user_burst
+            self.users.capacity = max(1, max_users)
+
+            for bucket in self.users.entries.values():
+                bucket.rate = user_rate
+                bucket.capacity = user_burst
+
+    def admit(self, user_id: int) -> bool:
+        with self.users.lock:
+            bucket = self.users.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+                self.users.put(user_id, bucket)
+
+        # the user's own budget comes first, so spamming users cannot drain the global one
+        if not bucket.try_acquire():
+            self.shed_user.increment()
+            return False
+
+        if not self.bucket.try_acquire():
+            self.shed_global.increment()
+            return False
+
+        self.admitted.increment()
+        return True
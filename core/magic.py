@@ -4,6 +4,7 @@ COLOR_PREMIUM = 0xDAA520
 COLOR_WARNING = 0xff1500
 
 PAYPAL_UPDATE_DELAY = 30
+INBOX_RETRY_DELAY = 30
 
 
 def encode(text: str) -> str:
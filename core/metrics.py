@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+__lock = threading.Lock()
+__latencies: Dict[str, "Latency"] = {}
+__counters: Dict[str, "Counter"] = {}
+
+
+class Latency:
+    def __init__(self, name: str, samples: int = 1000):
+        self.name = name
+        self.samples: deque[float] = deque(maxlen=samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start)
+
+    def percentile(self, p: float) -> float:
+        with self.lock:
+            values = sorted(self.samples)
+
+        if len(values) == 0:
+            return 0.0
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    def average(self) -> float:
+        with self.lock:
+            return 0.0 if self.count == 0 else self.total / self.count
+
+    def summary(self) -> str:
+        return f"{self.name}: n={self.count}, avg={self.average() * 1000:.1f}ms, " \
+               f"p50={self.percentile(50) * 1000:.1f}ms, p95={self.percentile(95) * 1000:.1f}ms, " \
+               f"max={self.max * 1000:.1f}ms"
+
+
+class Counter:
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self, amount: int = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def summary(self) -> str:
+        return f"{self.name}: {self.value}"
+
+
+def latency(name: str) -> Latency:
+    with __lock:
+        if name not in __latencies:
+            __latencies[name] = Latency(name)
+        return __latencies[name]
+
+
+def counter(name: str) -> Counter:
+    with __lock:
+        if name not in __counters:
+            __counters[name] = Counter(name)
+        return __counters[name]
+
+
+def report() -> List[str]:
+    with __lock:
+        counters = sorted(__counters.values(), key=lambda c: c.name)
+        latencies = sorted(__latencies.values(), key=lambda l: l.name)
+
+    return [c.summary() for c in counters] + [l.summary() for l in latencies]
@@ -1,176 +1,1054 @@
+import asyncio
 import datetime
-from typing import Optional, Literal
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Literal, Callable, Iterator, Tuple, TypeVar, Iterable, Dict, FrozenSet, Any, \
+    ContextManager, Sequence, Hashable, Set
 
 import mysql.connector.errors
 from mysql import connector
-from mysql.connector.errors import InterfaceError
+from mysql.connector.cursor import MySQLCursor
+from mysql.connector.errors import PoolError
 
-from core import files, log, magic
+from core import files, log, magic, metrics
+from core.cache import LRUCache
 
+T = TypeVar("T")
+
+# resource id, SpigotMC name, bought at, paid, tax, service
+Payment = Tuple[int, str, datetime.datetime, float, float, str]
+
+# like mysql, timestamps are stored without their time zone
+sqlite3.register_adapter(datetime.datetime, lambda date: date.replace(tzinfo=None).isoformat(" "))
+
+
+class ConnectionPool:
+    def __init__(self, factory: Callable[[], connector.MySQLConnection], size: int, timeout: float,
+                 health_check_after: float):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+
+        self.idle: deque[Tuple[connector.MySQLConnection, float]] = deque()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.failed = False
+        self.failed_at = 0.0
+
+    def checkout(self) -> connector.MySQLConnection:
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolError(msg=f"No database connection became available within {self.timeout}s "
+                                f"(pool size: {self.size}).")
+
+        try:
+            while True:
+                with self.lock:
+                    entry = self.idle.pop() if self.idle else None
+
+                if entry is None:
+                    return self.__connect__()
+
+                con, released_at = entry
+                if self.__is_healthy__(con, released_at):
+                    return con
+                self.__discard__(con)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, con: connector.MySQLConnection, broken: bool = False) -> None:
+        try:
+            if broken:
+                self.__discard__(con)
+            else:
+                with self.lock:
+                    self.idle.append((con, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    def available(self, retry_after: float) -> bool:
+        return not self.failed or time.monotonic() - self.failed_at >= retry_after
+
+    @contextmanager
+    def connection(self, con: Optional[connector.MySQLConnection] = None) -> Iterator[connector.MySQLConnection]:
+        if con is None:
+            con = self.checkout()
+        try:
+            yield con
+        except (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError):
+            # the socket might be dead, never hand it out again
+            self.checkin(con, broken=not self.__ping__(con))
+            raise
+        except BaseException:
+            self.checkin(con)
+            raise
+        else:
+            self.checkin(con)
+
+    def close(self) -> None:
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+
+        for con, _ in idle:
+            self.__discard__(con)
+
+    def __connect__(self) -> connector.MySQLConnection:
+        try:
+            con = self.factory()
+        except mysql.connector.errors.Error:
+            self.failed = True
+            self.failed_at = time.monotonic()
+            raise
+
+        self.failed = False
+        return con
+
+    def __is_healthy__(self, con: connector.MySQLConnection, released_at: float) -> bool:
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        return self.__ping__(con)
+
+    @staticmethod
+    def __ping__(con: connector.MySQLConnection) -> bool:
+        try:
+            con.ping(reconnect=False)
+            return True
+        except mysql.connector.errors.Error:
+            return False
+
+    @staticmethod
+    def __discard__(con: connector.MySQLConnection) -> None:
+        try:
+            con.close()
+        except mysql.connector.errors.Error:
+            pass
+
+
+class EntitlementCache:
+    def __init__(self, capacity: int):
+        # discord id -> (hashed SpigotMC name or None if not linked, bought resource ids)
+        self.entries: LRUCache[int, Tuple[Optional[str], FrozenSet[int]]] = \
+            LRUCache("database.entitlements", capacity, on_evict=self.__on_evict__)
+        # hashed SpigotMC name -> discord id of every cached, linked user
+        self.owners: Dict[str, int] = {}
+        self.lock = threading.RLock()
+        # incremented by every write so that concurrent loads cannot store outdated results
+        self.generation = 0
+
+    def get(self, user_id: int) -> Optional[Tuple[Optional[str], FrozenSet[int]]]:
+        return self.entries.get(user_id)
+
+    def peek(self, user_id: int) -> Optional[Tuple[Optional[str], FrozenSet[int]]]:
+        return self.entries.peek(user_id)
+
+    def put(self, user_id: int, spigot_hash: Optional[str], rids: Iterable[int],
+            generation: Optional[int] = None) -> None:
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self.__remove__(user_id)
+            self.entries.put(user_id, (spigot_hash, frozenset(rids)))
+            if spigot_hash is not None:
+                self.owners[spigot_hash] = user_id
+
+    def invalidate(self, user_id: int) -> None:
+        with self.lock:
+            self.generation += 1
+            self.__remove__(user_id)
+
+    def add_payments(self, payments: Iterable[Tuple[int, str]]) -> None:
+        with self.lock:
+            self.generation += 1
+
+            for rid, spigot_hash in payments:
+                user_id = self.owners.get(spigot_hash)
+                if user_id is None:
+                    continue
+
+                entry = self.entries.peek(user_id)
+                if entry is not None:
+                    self.entries.put(user_id, (spigot_hash, entry[1] | {rid}))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.owners.clear()
+
+    def __remove__(self, user_id: int) -> None:
+        entry = self.entries.pop(user_id)
+        if entry is not None:
+            self.__on_evict__(user_id, entry)
+
+    def __on_evict__(self, user_id: int, entry: Tuple[Optional[str], FrozenSet[int]]) -> None:
+        spigot_hash = entry[0]
+        if spigot_hash is not None and self.owners.get(spigot_hash) == user_id:
+            self.owners.pop(spigot_hash)
+
+
+class SettingsStore:
+    def __init__(self, writer: Callable[[Dict[str, str]], None], flush_delay: float):
+        self.writer = writer
+        self.flush_delay = flush_delay
+
+        self.values: Dict[str, str] = {}
+        self.dirty: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread: Optional[threading.Thread] = None
+
+    def load(self, values: Dict[str, str]) -> None:
+        with self.lock:
+            self.values = dict(values)
+            # keep pending writes which have not been flushed yet
+            self.values.update(self.dirty)
+
+    def get_str(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self.lock:
+            return self.values.get(key, default)
+
+    def get_int(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        value = self.get_str(key)
+        return default if value is None else int(value)
+
+    def set(self, key: str, value: str) -> None:
+        if len(key) > 100:
+            raise Exception("Key length must be <= 100")
+        if len(value) > 100:
+            raise Exception("Value length must be <= 100")
+
+        with self.lock:
+            if self.values.get(key) == value and key not in self.dirty:
+                return
+
+            self.values[key] = value
+            self.dirty[key] = value
+
+            if self.closed:
+                write_now = True
+            else:
+                write_now = False
+                self.__ensure_writer__()
+
+        if write_now:
+            self.flush()
+        else:
+            self.wakeup.set()
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                batch = self.dirty
+                self.dirty = {}
+
+            if len(batch) == 0:
+                return
+
+            try:
+                self.writer(batch)
+            except Exception:
+                with self.lock:
+                    # retry later unless a newer value has been set in the meantime
+                    for key, value in batch.items():
+                        self.dirty.setdefault(key, value)
+                raise
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+
+        self.wakeup.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def __ensure_writer__(self) -> None:
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.__run__, name="settings-writer", daemon=True)
+            self.thread.start()
+
+    def __run__(self) -> None:
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            if not self.closed:
+                # coalesce bursts of updates into a single write
+                time.sleep(self.flush_delay)
+
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Could not write settings to the database:", e)
+                time.sleep(self.flush_delay)
+                self.wakeup.set()
+
+
+def __index_columns__(cursor: MySQLCursor, table: str) -> Dict[str, Tuple[bool, Tuple[str, ...]]]:
+    cursor.execute("SELECT `index_name`, `non_unique`, `column_name` FROM information_schema.statistics "
+                   "WHERE `table_schema` = DATABASE() AND `table_name` = %s ORDER BY `index_name`, `seq_in_index`;",
+                   [table])
+
+    indexes: Dict[str, Tuple[bool, Tuple[str, ...]]] = {}
+    for name, non_unique, column in cursor.fetchall():
+        unique, columns = indexes.get(name, (int(non_unique) == 0, ()))
+        indexes[name] = (unique, columns + (column.lower(),))
+    return indexes
+
+
+def __drop_redundant_unique_indexes__(cursor: MySQLCursor, table: str) -> None:
+    indexes = __index_columns__(cursor, table)
+    primary = indexes.get("PRIMARY")
+    if primary is None:
+        return
+
+    for name, (unique, columns) in indexes.items():
+        if name != "PRIMARY" and unique and columns == primary[1]:
+            cursor.execute(f"ALTER TABLE `{table}` DROP INDEX `{name}`;")
+
+
+def __create_initial_tables__(cursor: MySQLCursor) -> None:
+    cursor.execute("CREATE TABLE IF NOT EXISTS `user_payments` ("
+                   "resource MEDIUMINT(6) NOT NULL,"
+                   "spigot_name VARCHAR(64) NOT NULL,"
+                   "bought_at timestamp NOT NULL,"
+                   "paid FLOAT(6, 2) NOT NULL,"
+                   "tax FLOAT(6,2) NOT NULL,"
+                   "service VARCHAR(30) NOT NULL,"
+                   "PRIMARY KEY (resource, spigot_name),"
+                   "UNIQUE (resource, spigot_name)"
+                   ");")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS `user_links` ("
+                   "discord_id BIGINT(18) NOT NULL PRIMARY KEY UNIQUE,"
+                   "spigot_name VARCHAR(64) NOT NULL UNIQUE,"
+                   "linked_at timestamp NOT NULL DEFAULT now()"
+                   ");")
+
+
+def __index_spigot_names__(cursor: MySQLCursor) -> None:
+    # names are stored as lowercase sha256 hex digests (see magic.encode)
+    for table in ["user_payments", "user_links"]:
+        cursor.execute(f"ALTER TABLE `{table}` MODIFY `spigot_name` "
+                       f"CHAR(64) CHARACTER SET ascii COLLATE ascii_bin NOT NULL;")
+        __drop_redundant_unique_indexes__(cursor, table)
+
+    indexes = __index_columns__(cursor, "user_payments")
+    if not any(columns[0] == "spigot_name" for _, columns in indexes.values()):
+        cursor.execute("ALTER TABLE `user_payments` ADD INDEX `idx_user_payments_spigot_name` (`spigot_name`);")
+
+
+def __create_pending_promotions__(cursor: MySQLCursor) -> None:
+    cursor.execute("CREATE TABLE IF NOT EXISTS `pending_promotions` ("
+                   "discord_id BIGINT(18) NOT NULL PRIMARY KEY,"
+                   "spigot_name CHAR(64) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,"
+                   "promotion_key INT NOT NULL,"
+                   "started_at timestamp NOT NULL"
+                   ");")
+
+
+def __create_sqlite_tables__(cursor: "SQLiteCursor") -> None:
+    cursor.execute("CREATE TABLE IF NOT EXISTS `user_payments` ("
+                   "resource INTEGER NOT NULL,"
+                   "spigot_name CHAR(64) NOT NULL,"
+                   "bought_at TIMESTAMP NOT NULL,"
+                   "paid REAL NOT NULL,"
+                   "tax REAL NOT NULL,"
+                   "service VARCHAR(30) NOT NULL,"
+                   "PRIMARY KEY (resource, spigot_name)"
+                   ");")
+    cursor.execute("CREATE INDEX IF NOT EXISTS `idx_user_payments_spigot_name` ON `user_payments` (`spigot_name`);")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS `user_links` ("
+                   "discord_id INTEGER NOT NULL PRIMARY KEY,"
+                   "spigot_name CHAR(64) NOT NULL UNIQUE,"
+                   "linked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"
+                   ");")
+
+
+def __create_sqlite_pending_promotions__(cursor: "SQLiteCursor") -> None:
+    cursor.execute("CREATE TABLE IF NOT EXISTS `pending_promotions` ("
+                   "discord_id INTEGER NOT NULL PRIMARY KEY,"
+                   "spigot_name CHAR(64) NOT NULL,"
+                   "promotion_key INTEGER NOT NULL,"
+                   "started_at TIMESTAMP NOT NULL"
+                   ");")
+
+
+SCHEMA_VERSION_KEY = "schema_version"
+# never reorder or edit released migrations, append new ones instead
+MYSQL_MIGRATIONS: list[Callable[[MySQLCursor], None]] = [
+    __create_initial_tables__,
+    __index_spigot_names__,
+    __create_pending_promotions__,
+]
+SQLITE_MIGRATIONS: list[Callable[["SQLiteCursor"], None]] = [
+    __create_sqlite_tables__,
+    __create_sqlite_pending_promotions__,
+]
+
+
+class Database(ABC):
+    INSERT_IGNORE = "INSERT IGNORE"
+    UPSERT_SETTING = "INSERT INTO `settings` VALUES (%s, %s) ON DUPLICATE KEY UPDATE `value`=VALUES(`value`)"
+    MAX_LOOKUP_CHUNK_SIZE = 100000
+    MIGRATIONS: list[Callable[[Any], None]] = []
 
-class MySQL:
     def __init__(self, config: files.Config):
         self.first_paypal_fetch = config.paypal().begin_date()
         self.config = config.database()
-        self.con: Optional[mysql.connector.MySQLConnection] = None
+        self.entitlements = EntitlementCache(self.config.entitlement_cache_size())
+        self.settings = SettingsStore(self.__write_settings__, self.config.settings_flush_delay())
+        self.change_listeners: list[Callable[[Set[int]], None]] = []
 
+    @abstractmethod
     def build_connection(self, logging: bool = True) -> None:
-        if logging:
-            log.info("Connecting to mysql database...")
+        ...
 
-        password = self.config.password()
-        if password is not None and len(password) == 0:
-            password = None
+    @abstractmethod
+    def has_valid_con(self) -> bool:
+        ...
 
-        try:
-            self.con = connector.connect(
-                host=self.config.host(),
-                port=self.config.port(),
-                user=self.config.user(),
-                password=password,
-                database=self.config.database(),
-                autocommit=True
-            )
+    @abstractmethod
+    def close(self) -> None:
+        ...
 
-            self.__create_tables__()
-        except mysql.connector.errors.ProgrammingError:
-            if logging:
-                log.error("Could not connect to your mysql database. Please check your credentials!")
-            self.con = None
+    @abstractmethod
+    def __cursor__(self, prepared: bool = False) -> ContextManager[Any]:
+        ...
 
-    def has_valid_con(self):
-        if self.con:
-            if self.con.is_connected():
-                return True
+    @abstractmethod
+    def __transaction__(self) -> ContextManager[Any]:
+        ...
 
-            self.build_connection(False)
-            return self.con is not None
-        return False
+    def __read_cursor__(self, keys: Iterable[Hashable] = (), prepared: bool = False) -> ContextManager[Any]:
+        return self.__cursor__(prepared)
 
-    def __create_tables__(self) -> None:
-        if self.con is None:
+    def __mark_written__(self, keys: Iterable[Hashable]) -> None:
+        pass
+
+    def add_change_listener(self, listener: Callable[[Set[int]], None]) -> None:
+        self.change_listeners.append(listener)
+
+    def __notify_changes__(self, user_ids: Set[int]) -> None:
+        if len(user_ids) == 0:
             return
 
-        with self.con.cursor() as cursor:
-            cursor.execute("CREATE TABLE IF NOT EXISTS `user_payments` ("
-                           "resource MEDIUMINT(6) NOT NULL,"
-                           "spigot_name VARCHAR(64) NOT NULL,"
-                           "bought_at timestamp NOT NULL,"
-                           "paid FLOAT(6, 2) NOT NULL,"
-                           "tax FLOAT(6,2) NOT NULL,"
-                           "service VARCHAR(30) NOT NULL,"
-                           "PRIMARY KEY (resource, spigot_name),"
-                           "UNIQUE (resource, spigot_name)"
-                           ");")
+        for listener in self.change_listeners:
+            try:
+                listener(user_ids)
+            except Exception as e:
+                log.error("Could not notify a database change listener:", e)
 
-            cursor.execute("CREATE TABLE IF NOT EXISTS `user_links` ("
-                           "discord_id BIGINT(18) NOT NULL PRIMARY KEY UNIQUE,"
-                           "spigot_name VARCHAR(64) NOT NULL UNIQUE,"
-                           "linked_at timestamp NOT NULL DEFAULT now()"
-                           ");")
+    def __to_datetime__(self, value: Any) -> datetime.datetime:
+        return value
 
+    def __initialize__(self) -> None:
+        self.__create_tables__()
+        self.__load_settings__()
+        self.__load_entitlements__()
+
+    def __create_tables__(self) -> None:
+        with self.__cursor__() as cursor:
             cursor.execute("CREATE TABLE IF NOT EXISTS `settings` ("
                            "`key` VARCHAR(100) NOT NULL PRIMARY KEY UNIQUE,"
                            "`value` VARCHAR(100) NOT NULL"
                            ");")
 
+            cursor.execute("SELECT `value` FROM `settings` WHERE `key` = %s LIMIT 1;", [SCHEMA_VERSION_KEY])
+            result = cursor.fetchone()
+            version = 0 if result is None else int(result[0])
+
+            if version > len(self.MIGRATIONS):
+                log.warning(f"The database schema version {version} is newer than this bot "
+                            f"(version {len(self.MIGRATIONS)}).")
+
+            for target in range(version + 1, len(self.MIGRATIONS) + 1):
+                log.info(f"Migrating database schema to version {target}...")
+                self.MIGRATIONS[target - 1](cursor)
+                cursor.execute(self.UPSERT_SETTING, [SCHEMA_VERSION_KEY, str(target)])
+
+    def __load_entitlements__(self) -> None:
+        with self.__cursor__() as cursor:
+            cursor.execute("SELECT ul.discord_id, ul.spigot_name, up.resource FROM `user_links` ul "
+                           "LEFT JOIN `user_payments` up ON up.spigot_name = ul.spigot_name;")
+
+            entitlements: Dict[int, Tuple[str, set[int]]] = {}
+            for user_id, spigot_hash, rid in cursor.fetchall():
+                _, rids = entitlements.setdefault(user_id, (spigot_hash, set()))
+                if rid is not None:
+                    rids.add(rid)
+
+        self.entitlements.clear()
+        for user_id, (spigot_hash, rids) in entitlements.items():
+            self.entitlements.put(user_id, spigot_hash, rids)
+
+        log.info(f"Cached the purchases of {len(self.entitlements.entries)} linked user(s).")
+
     def get_last_paypal_fetch(self) -> str:
-        return self.__get_setting__("last_paypal_fetch", self.first_paypal_fetch)
+        return self.settings.get_str("last_paypal_fetch", self.first_paypal_fetch)
 
     def set_last_paypal_fetch(self, date) -> None:
-        self.__update_setting__("last_paypal_fetch", date)
+        self.settings.set("last_paypal_fetch", date)
 
     def get_last_stripe_fetch(self) -> Optional[str]:
-        return self.__get_setting__("last_stripe_fetch", None)
+        return self.settings.get_str("last_stripe_fetch", None)
 
     def set_last_stripe_fetch(self, checkout_id: str) -> None:
-        self.__update_setting__("last_stripe_fetch", checkout_id)
+        self.settings.set("last_stripe_fetch", checkout_id)
 
-    def __update_setting__(self, key: str, value: str) -> None:
-        if len(key) > 100:
-            raise Exception("Key length must be <= 100")
-        if len(value) > 100:
-            raise Exception("Value length must be <= 100")
+    def get_last_mail_uid(self) -> Tuple[Optional[int], int]:
+        # uid validity of the inbox and the highest uid which has been processed in it
+        return self.settings.get_int("mail_uid_validity"), self.settings.get_int("last_mail_uid", 0)
 
-        with self.con.cursor(prepared=True) as cursor:
-            cursor.execute("INSERT INTO `settings` VALUES (%s, %s) ON DUPLICATE KEY UPDATE `value`=%s;",
-                           [key, value, value])
+    def set_last_mail_uid(self, uid_validity: int, uid: int) -> None:
+        self.settings.set("mail_uid_validity", str(uid_validity))
+        self.settings.set("last_mail_uid", str(uid))
 
-    def __get_setting__(self, key: str, default: Optional[str]) -> Optional[str]:
-        with self.con.cursor(prepared=True) as cursor:
-            cursor.execute("SELECT `value` FROM `settings` WHERE `key` = %s LIMIT 1;", [key])
-            result = cursor.fetchone()
-            return default if result is None else result[0]
+    def __load_settings__(self) -> None:
+        with self.__cursor__() as cursor:
+            cursor.execute("SELECT `key`, `value` FROM `settings`;")
+            self.settings.load({key: value for key, value in cursor.fetchall()})
+
+    def __write_settings__(self, values: Dict[str, str]) -> None:
+        with self.__cursor__() as cursor:
+            cursor.executemany(self.UPSERT_SETTING, list(values.items()))
 
     def get_latest_paypal_transaction_date(self) -> datetime.datetime:
-        with self.con.cursor(prepared=True) as cursor:
+        with self.__cursor__(prepared=True) as cursor:
             cursor.execute("SELECT MAX(`bought_at`) FROM `user_payments`;", [])
             result = cursor.fetchone()
-            return self.first_paypal_fetch if result is None else result[0]
+
+        if result is None or result[0] is None:
+            begin = datetime.datetime.fromisoformat(self.first_paypal_fetch.replace("Z", "+00:00"))
+            return begin.replace(tzinfo=None)
+        return self.__to_datetime__(result[0])
 
     def add_payment(self, resource_id: int, spigot_name: str, bought_at: datetime.datetime, paid: float, tax: float,
                     service: Literal["paypal", "stripe"]) -> None:
-        with self.con.cursor(prepared=True) as cursor:
-            encoded_spigot_name = magic.encode(spigot_name)
+        self.add_payments([(resource_id, spigot_name, bought_at, paid, tax, service)])
 
-            try:
-                cursor.execute("INSERT INTO `user_payments` VALUES (%s, %s, %s, %s, %s, %s);",
-                               [resource_id, encoded_spigot_name, bought_at, paid, tax, service])
-            except InterfaceError as e:
-                if "Duplicate entry" not in e.msg:
-                    print(e)
-            except Exception as e:
-                print(e)
+    def add_payments(self, payments: Iterable[Payment]) -> Tuple[int, int]:
+        rows = [(rid, magic.encode(spigot_name), bought_at, paid, tax, service)
+                for rid, spigot_name, bought_at, paid, tax, service in payments]
+        if len(rows) == 0:
+            return 0, 0
+
+        chunk_size = self.config.insert_chunk_size()
+        inserted = 0
+
+        with self.__transaction__() as cursor:
+            for i in range(0, len(rows), chunk_size):
+                # mysql rewrites each chunk into a single multi-row INSERT
+                cursor.executemany(f"{self.INSERT_IGNORE} INTO `user_payments` VALUES (%s, %s, %s, %s, %s, %s)",
+                                   rows[i:i + chunk_size])
+                inserted += max(0, cursor.rowcount)
+
+        hashes = {row[1] for row in rows}
+        self.__mark_written__(hashes | {self.entitlements.owners[h] for h in hashes if h in self.entitlements.owners})
+        self.entitlements.add_payments((row[0], row[1]) for row in rows)
+
+        if inserted > 0 and len(self.change_listeners) > 0:
+            self.__notify_changes__(self.__get_linked_users__(hashes))
+        return inserted, len(rows) - inserted
+
+    def __get_linked_users__(self, spigot_hashes: Iterable[str]) -> Set[int]:
+        spigot_hashes = list(spigot_hashes)
+        user_ids = set()
+
+        chunk_size = min(self.config.lookup_chunk_size(), self.MAX_LOOKUP_CHUNK_SIZE)
+        for i in range(0, len(spigot_hashes), chunk_size):
+            chunk = spigot_hashes[i:i + chunk_size]
+            with self.__cursor__() as cursor:
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute(f"SELECT `discord_id` FROM `user_links` WHERE `spigot_name` IN ({placeholders});",
+                               chunk)
+                user_ids.update(row[0] for row in cursor.fetchall())
+        return user_ids
 
     def is_user_linked(self, user_id: int) -> bool:
-        with self.con.cursor(prepared=True) as cursor:
+        cached = self.entitlements.peek(user_id)
+        if cached is not None:
+            return cached[0] is not None
+
+        with self.__read_cursor__([user_id], prepared=True) as cursor:
             cursor.execute("SELECT `spigot_name` FROM `user_links` WHERE `discord_id` = %s LIMIT 1;",
                            [user_id])
             result = cursor.fetchone()
             return result is not None
 
     def is_spigot_name_linked(self, spigot_name: str, do_hash: bool = True) -> bool:
-        with self.con.cursor(prepared=True) as cursor:
-            if do_hash:
-                spigot_name = magic.encode(spigot_name)
+        if do_hash:
+            spigot_name = magic.encode(spigot_name)
 
-            cursor.execute("SELECT `discord_id` FROM `user_links` WHERE `spigot_name` LIKE %s LIMIT 1;",
+        with self.__read_cursor__([spigot_name], prepared=True) as cursor:
+            cursor.execute("SELECT `discord_id` FROM `user_links` WHERE `spigot_name` = %s LIMIT 1;",
                            [spigot_name])
             result = cursor.fetchone()
             return result is not None
 
     def invalidate_link(self, user_id: int) -> None:
-        with self.con.cursor(prepared=True) as cursor:
+        with self.__cursor__(prepared=True) as cursor:
             cursor.execute("DELETE FROM `user_links` WHERE `discord_id` = %s;",
                            [user_id])
 
-    def link_user(self, user_id: int, spigot_name: str) -> None:
-        with self.con.cursor(prepared=True) as cursor:
-            encoded_spigot_name = magic.encode(spigot_name)
-            try:
-                cursor.execute("INSERT INTO `user_links` (`discord_id`, `spigot_name`) VALUES (%s, %s);",
-                               [user_id, encoded_spigot_name])
-            except InterfaceError:
-                pass
+        cached = self.entitlements.peek(user_id)
+        self.__mark_written__([user_id] if cached is None or cached[0] is None else [user_id, cached[0]])
+        self.entitlements.invalidate(user_id)
+        self.entitlements.put(user_id, None, [])
+        self.__notify_changes__({user_id})
+
+    def link_user(self, user_id: int, spigot_name: str, do_hash: bool = True) -> None:
+        with self.__cursor__(prepared=True) as cursor:
+            encoded_spigot_name = magic.encode(spigot_name) if do_hash else spigot_name
+            cursor.execute(f"{self.INSERT_IGNORE} INTO `user_links` (`discord_id`, `spigot_name`) VALUES (%s, %s);",
+                           [user_id, encoded_spigot_name])
+
+        self.__mark_written__([user_id, encoded_spigot_name])
+        self.entitlements.invalidate(user_id)
+        self.__notify_changes__({user_id})
 
     def get_bought_rids(self, user_id: int) -> list[int]:
-        with self.con.cursor(prepared=True) as cursor:
-            cursor.execute("SELECT `resource` FROM `user_payments` up "
-                           "INNER JOIN `user_links` ul ON up.spigot_name = ul.spigot_name "
+        cached = self.entitlements.get(user_id)
+        if cached is not None:
+            return list(cached[1])
+
+        generation = self.entitlements.generation
+        with self.__read_cursor__([user_id], prepared=True) as cursor:
+            cursor.execute("SELECT ul.spigot_name, up.resource FROM `user_links` ul "
+                           "LEFT JOIN `user_payments` up ON up.spigot_name = ul.spigot_name "
                            "WHERE ul.discord_id = %s;",
                            [user_id])
             result = cursor.fetchall()
 
-            rids = []
-            for r in result:
-                rids.append(r[0])
-            return rids
+        spigot_hash = None
+        rids = []
+        for name, rid in result:
+            spigot_hash = name
+            if rid is not None:
+                rids.append(rid)
+
+        self.entitlements.put(user_id, spigot_hash, rids, generation)
+        return rids
+
+    def get_bought_rids_bulk(self, user_ids: Iterable[int]) -> Dict[int, list[int]]:
+        result: Dict[int, list[int]] = {}
+        missing = []
+
+        for user_id in set(user_ids):
+            cached = self.entitlements.get(user_id)
+            if cached is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = list(cached[1])
+
+        chunk_size = min(self.config.lookup_chunk_size(), self.MAX_LOOKUP_CHUNK_SIZE)
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            generation = self.entitlements.generation
+
+            with self.__read_cursor__(chunk) as cursor:
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute("SELECT ul.discord_id, ul.spigot_name, up.resource FROM `user_links` ul "
+                               "LEFT JOIN `user_payments` up ON up.spigot_name = ul.spigot_name "
+                               f"WHERE ul.discord_id IN ({placeholders});",
+                               chunk)
+                rows = cursor.fetchall()
+
+            hashes: Dict[int, str] = {}
+            for user_id, spigot_hash, rid in rows:
+                hashes[user_id] = spigot_hash
+                rids = result.setdefault(user_id, [])
+                if rid is not None:
+                    rids.append(rid)
+
+            for user_id in chunk:
+                self.entitlements.put(user_id, hashes.get(user_id), result.setdefault(user_id, []), generation)
+
+        return result
 
     def is_premium_user(self, spigot_name: str) -> bool:
-        with self.con.cursor(prepared=True) as cursor:
-            encoded_spigot_name = magic.encode(spigot_name)
+        encoded_spigot_name = magic.encode(spigot_name)
 
-            cursor.execute("SELECT 1 FROM `user_payments` WHERE `spigot_name` LIKE %s LIMIT 1;",
+        with self.__read_cursor__([encoded_spigot_name], prepared=True) as cursor:
+            cursor.execute("SELECT 1 FROM `user_payments` WHERE `spigot_name` = %s LIMIT 1;",
                            [encoded_spigot_name])
             result = cursor.fetchone()
             return result is not None
+
+    def get_pending_promotions(self, started_after: datetime.datetime) -> list[Tuple[int, str, int, datetime.datetime]]:
+        with self.__cursor__(prepared=True) as cursor:
+            cursor.execute("SELECT `discord_id`, `spigot_name`, `promotion_key`, `started_at` "
+                           "FROM `pending_promotions` WHERE `started_at` > %s ORDER BY `started_at`;",
+                           [started_after])
+            rows = cursor.fetchall()
+
+        return [(user_id, spigot_name, key, self.__to_datetime__(started_at))
+                for user_id, spigot_name, key, started_at in rows]
+
+    def add_pending_promotion(self, user_id: int, encoded_spigot_name: str, key: int,
+                              started_at: datetime.datetime) -> None:
+        with self.__cursor__(prepared=True) as cursor:
+            cursor.execute("REPLACE INTO `pending_promotions` "
+                           "(`discord_id`, `spigot_name`, `promotion_key`, `started_at`) VALUES (%s, %s, %s, %s);",
+                           [user_id, encoded_spigot_name, key, started_at])
+
+    def purge_expired_promotions(self, started_before: datetime.datetime) -> int:
+        with self.__cursor__(prepared=True) as cursor:
+            cursor.execute("DELETE FROM `pending_promotions` WHERE `started_at` <= %s;",
+                           [started_before])
+            return max(0, cursor.rowcount)
+
+    def remove_pending_promotions(self, user_ids: list[int]) -> None:
+        if len(user_ids) == 0:
+            return
+
+        with self.__cursor__() as cursor:
+            placeholders = ", ".join(["%s"] * len(user_ids))
+            cursor.execute(f"DELETE FROM `pending_promotions` WHERE `discord_id` IN ({placeholders});",
+                           user_ids)
+
+
+class MySQL(Database):
+    MIGRATIONS = MYSQL_MIGRATIONS
+
+    def __init__(self, config: files.Config):
+        super().__init__(config)
+        self.pool: Optional[ConnectionPool] = None
+        self.replicas: list[ConnectionPool] = []
+        self.next_replica = 0
+
+        # keys (discord ids, hashed SpigotMC names) written recently -> time of the write
+        self.recent_writes: OrderedDict[Hashable, float] = OrderedDict()
+        self.recent_writes_lock = threading.Lock()
+
+    def build_connection(self, logging: bool = True) -> None:
+        if logging:
+            log.info(f"Connecting to mysql database (pool size: {self.config.pool_size()}, "
+                     f"read replicas: {len(self.config.replicas())})...")
+
+        self.close_pools()
+
+        self.pool = self.__create_pool__({})
+        self.replicas = [self.__create_pool__(replica) for replica in self.config.replicas()]
+
+        try:
+            self.__initialize__()
+        except mysql.connector.errors.Error as e:
+            if logging:
+                log.error("Could not connect to your mysql database. Please check your credentials!", e)
+            self.pool = None
+
+    def __create_pool__(self, endpoint: dict) -> ConnectionPool:
+        return ConnectionPool(
+            lambda: self.__connect__(endpoint),
+            self.config.pool_size(),
+            self.config.pool_timeout(),
+            self.config.pool_health_check_after()
+        )
+
+    def __connect__(self, endpoint: dict) -> connector.MySQLConnection:
+        password = endpoint.get("password", self.config.password())
+        if password is not None and len(password) == 0:
+            password = None
+
+        return connector.connect(
+            host=endpoint.get("host", self.config.host()),
+            port=int(endpoint.get("port", self.config.port())),
+            user=endpoint.get("user", self.config.user()),
+            password=password,
+            database=endpoint.get("database", self.config.database()),
+            autocommit=True
+        )
+
+    def has_valid_con(self) -> bool:
+        if self.pool is None:
+            return False
+
+        if self.pool.failed:
+            # try to recover once the server is reachable again
+            try:
+                with self.pool.connection():
+                    pass
+            except mysql.connector.errors.Error:
+                return False
+        return True
+
+    def close(self) -> None:
+        if self.pool is not None:
+            try:
+                self.settings.close()
+            except mysql.connector.errors.Error as e:
+                log.error("Could not flush settings before closing the database connections:", e)
+        self.close_pools()
+
+    def close_pools(self) -> None:
+        for pool in [self.pool] + self.replicas:
+            if pool is not None:
+                pool.close()
+
+    @contextmanager
+    def __cursor__(self, prepared: bool = False) -> Iterator[MySQLCursor]:
+        with self.pool.connection() as con:
+            with con.cursor(prepared=prepared) as cursor:
+                yield cursor
+
+    @contextmanager
+    def __read_cursor__(self, keys: Iterable[Hashable] = (), prepared: bool = False) -> Iterator[MySQLCursor]:
+        pool = self.__read_pool__(keys)
+
+        try:
+            con = pool.checkout()
+        except mysql.connector.errors.Error as e:
+            if pool is self.pool:
+                raise
+            log.warning("Read replica is not available, falling back to the primary database:", e)
+            pool = self.pool
+            con = pool.checkout()
+
+        metrics.counter("database.reads.primary" if pool is self.pool else "database.reads.replica").increment()
+        with pool.connection(con):
+            with con.cursor(prepared=prepared) as cursor:
+                yield cursor
+
+    def __read_pool__(self, keys: Iterable[Hashable]) -> ConnectionPool:
+        if len(self.replicas) == 0 or self.__written_recently__(keys):
+            return self.pool
+
+        retry_after = self.config.pool_health_check_after()
+        for _ in range(len(self.replicas)):
+            self.next_replica = (self.next_replica + 1) % len(self.replicas)
+            replica = self.replicas[self.next_replica]
+            if replica.available(retry_after):
+                return replica
+        return self.pool
+
+    def __mark_written__(self, keys: Iterable[Hashable]) -> None:
+        if len(self.replicas) == 0:
+            return
+
+        now = time.monotonic()
+        with self.recent_writes_lock:
+            for key in keys:
+                self.recent_writes[key] = now
+                self.recent_writes.move_to_end(key)
+            self.__forget_old_writes__(now)
+
+    def __written_recently__(self, keys: Iterable[Hashable]) -> bool:
+        with self.recent_writes_lock:
+            self.__forget_old_writes__(time.monotonic())
+            return any(key in self.recent_writes for key in keys)
+
+    def __forget_old_writes__(self, now: float) -> None:
+        # replicas are expected to have caught up after this window
+        window = self.config.replica_lag()
+        while len(self.recent_writes) > 0:
+            key, written_at = next(iter(self.recent_writes.items()))
+            if now - written_at < window:
+                break
+            self.recent_writes.popitem(last=False)
+
+    @contextmanager
+    def __transaction__(self) -> Iterator[MySQLCursor]:
+        with self.pool.connection() as con:
+            con.start_transaction()
+            try:
+                with con.cursor() as cursor:
+                    yield cursor
+                con.commit()
+            except BaseException:
+                con.rollback()
+                raise
+
+
+class SQLiteCursor:
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    def execute(self, sql: str, params: Sequence = ()) -> None:
+        self.cursor.execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql: str, params: Iterable[Sequence]) -> None:
+        self.cursor.executemany(sql.replace("%s", "?"), params)
+
+    def fetchone(self) -> Optional[tuple]:
+        return self.cursor.fetchone()
+
+    def fetchall(self) -> list[tuple]:
+        return self.cursor.fetchall()
+
+
+class SQLite(Database):
+    INSERT_IGNORE = "INSERT OR IGNORE"
+    UPSERT_SETTING = "INSERT INTO `settings` VALUES (%s, %s) ON CONFLICT(`key`) DO UPDATE SET `value`=excluded.`value`"
+    # stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions
+    MAX_LOOKUP_CHUNK_SIZE = 900
+    MIGRATIONS = SQLITE_MIGRATIONS
+
+    def __init__(self, config: files.Config):
+        super().__init__(config)
+        self.local = threading.local()
+        self.connections: list[sqlite3.Connection] = []
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def build_connection(self, logging: bool = True) -> None:
+        if logging:
+            log.info(f"Opening sqlite database '{self.config.file_name()}'...")
+
+        try:
+            self.__initialize__()
+            self.ready = True
+        except sqlite3.Error as e:
+            if logging:
+                log.error("Could not open your sqlite database. Please check the database section in your config!", e)
+            self.ready = False
+
+    def has_valid_con(self) -> bool:
+        return self.ready
+
+    def close(self) -> None:
+        try:
+            self.settings.close()
+        except sqlite3.Error as e:
+            log.error("Could not flush settings before closing the database connections:", e)
+
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+
+        for con in connections:
+            con.close()
+
+    def __connection__(self) -> sqlite3.Connection:
+        # one connection per thread, WAL mode lets readers run next to the single writer
+        con: Optional[sqlite3.Connection] = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(
+                self.config.file_name(),
+                timeout=self.config.pool_timeout(),
+                isolation_level=None,
+                check_same_thread=False
+            )
+            con.execute("PRAGMA journal_mode=WAL;")
+            con.execute("PRAGMA synchronous=NORMAL;")
+
+            self.local.con = con
+            with self.lock:
+                self.connections.append(con)
+        return con
+
+    @contextmanager
+    def __cursor__(self, prepared: bool = False) -> Iterator[SQLiteCursor]:
+        cursor = self.__connection__().cursor()
+        try:
+            yield SQLiteCursor(cursor)
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def __transaction__(self) -> Iterator[SQLiteCursor]:
+        con = self.__connection__()
+        cursor = con.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+        try:
+            yield SQLiteCursor(cursor)
+            cursor.execute("COMMIT;")
+        except BaseException:
+            cursor.execute("ROLLBACK;")
+            raise
+        finally:
+            cursor.close()
+
+    def __to_datetime__(self, value: Any) -> datetime.datetime:
+        if isinstance(value, str):
+            # rows written before the adapter dropped the time zone still carry an offset
+            return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+        return value
+
+
+def create(config: files.Config) -> Database:
+    if config.database().backend() == "sqlite":
+        return SQLite(config)
+    return MySQL(config)
+
+
+class AsyncDatabase:
+    def __init__(self, db: Database, config: files.Database):
+        self.db = db
+        self.slow_query = config.slow_query()
+
+        workers = config.pool_size()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="database")
+        # bounds the number of queries waiting for a worker
+        self.slots = asyncio.Semaphore(workers + config.queue_size())
+
+    async def __run__(self, name: str, func: Callable[..., T], *args) -> T:
+        start = time.perf_counter()
+
+        async with self.slots:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+        elapsed = time.perf_counter() - start
+        metrics.latency(f"database.{name}").record(elapsed)
+        if elapsed >= self.slow_query:
+            log.warning(f"Slow database query '{name}' took {elapsed * 1000:.0f}ms.")
+        return result
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def add_change_listener(self, listener: Callable[[Set[int]], None]) -> None:
+        # listeners are called by the worker thread which ran the write, never on the event loop
+        self.db.add_change_listener(listener)
+
+    async def is_user_linked(self, user_id: int) -> bool:
+        return await self.__run__("is_user_linked", self.db.is_user_linked, user_id)
+
+    async def is_spigot_name_linked(self, spigot_name: str, do_hash: bool = True) -> bool:
+        return await self.__run__("is_spigot_name_linked", self.db.is_spigot_name_linked, spigot_name, do_hash)
+
+    async def invalidate_link(self, user_id: int) -> None:
+        await self.__run__("invalidate_link", self.db.invalidate_link, user_id)
+
+    async def link_user(self, user_id: int, spigot_name: str, do_hash: bool = True) -> None:
+        await self.__run__("link_user", self.db.link_user, user_id, spigot_name, do_hash)
+
+    async def get_bought_rids(self, user_id: int) -> list[int]:
+        return await self.__run__("get_bought_rids", self.db.get_bought_rids, user_id)
+
+    async def get_bought_rids_bulk(self, user_ids: Iterable[int]) -> Dict[int, list[int]]:
+        return await self.__run__("get_bought_rids_bulk", self.db.get_bought_rids_bulk, list(user_ids))
+
+    async def is_premium_user(self, spigot_name: str) -> bool:
+        return await self.__run__("is_premium_user", self.db.is_premium_user, spigot_name)
+
+    async def get_pending_promotions(self, started_after: datetime.datetime) \
+            -> list[Tuple[int, str, int, datetime.datetime]]:
+        return await self.__run__("get_pending_promotions", self.db.get_pending_promotions, started_after)
+
+    async def add_pending_promotion(self, user_id: int, encoded_spigot_name: str, key: int,
+                                    started_at: datetime.datetime) -> None:
+        await self.__run__("add_pending_promotion", self.db.add_pending_promotion, user_id, encoded_spigot_name, key,
+                           started_at)
+
+    async def purge_expired_promotions(self, started_before: datetime.datetime) -> int:
+        return await self.__run__("purge_expired_promotions", self.db.purge_expired_promotions, started_before)
+
+    async def remove_pending_promotions(self, user_ids: Iterable[int]) -> None:
+        await self.__run__("remove_pending_promotions", self.db.remove_pending_promotions, list(user_ids))
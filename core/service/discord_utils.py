@@ -1,9 +1,14 @@
-from typing import Optional, Tuple, Set
+import asyncio
+import threading
+import time
+from typing import Optional, Set, Iterable, Callable
 
 import nextcord
 from nextcord.ext.commands import Bot
 
-from core import files, log
+from core import files, log, metrics
+from core.cache import TTLCache, SingleFlight
+from core.limits import TokenBucket
 from core.service import database
 
 
@@ -16,44 +21,166 @@ def compare_rank(a: nextcord.Member, b: nextcord.Member) -> int:
         return 1
 
 
+def roles_changed(old: files.Discord, new: files.Discord) -> bool:
+    return old.guild_id() != new.guild_id() \
+           or old.premium_role() != new.premium_role() \
+           or old.roles() != new.roles()
+
+
+class RoleRegistry:
+    def __init__(self, config: files.Discord):
+        self.config = config
+
+        self.premium_role: Optional[nextcord.Role] = None
+        self.roles: dict[int, nextcord.Role] = {}
+
+    def rebuild(self, guild: nextcord.Guild) -> None:
+        self.premium_role = None
+        self.roles = {}
+
+        for role in guild.roles:
+            self.update(role)
+
+    def update(self, role: nextcord.Role) -> None:
+        if role.id == self.config.premium_role():
+            self.premium_role = role
+            return
+
+        rid = self.config.rid_by_role(role.id)
+        if rid is not None:
+            self.roles[rid] = role
+
+    def remove(self, role: nextcord.Role) -> None:
+        if self.premium_role is not None and role.id == self.premium_role.id:
+            self.premium_role = None
+            return
+
+        rid = self.config.rid_by_role(role.id)
+        if rid is not None and rid in self.roles and self.roles[rid].id == role.id:
+            self.roles.pop(rid)
+
+    def get_role(self, rid: int) -> Optional[nextcord.Role]:
+        return self.roles.get(rid)
+
+    def is_managed(self, role: nextcord.Role) -> bool:
+        return role.id == self.config.premium_role() or self.config.rid_by_role(role.id) is not None
+
+
+class MemberResolver:
+    def __init__(self, config: files.Discord, guild: Callable[[], nextcord.Guild]):
+        self.config = config
+        self.guild = guild
+
+        self.cache: TTLCache[int, Optional[nextcord.Member]] = \
+            TTLCache("members.cache", config.member_cache_size(), config.member_cache_ttl())
+        self.requests: SingleFlight[int, Optional[nextcord.Member]] = SingleFlight()
+
+        self.gateway_hits = metrics.counter("members.gateway.hits")
+        self.rest_requests = metrics.counter("members.rest.requests")
+        self.shared_requests = metrics.counter("members.rest.shared")
+
+    def reload(self, config: files.Discord) -> None:
+        if config.guild_id() != self.config.guild_id():
+            self.cache.clear()
+
+        self.config = config
+        self.cache.capacity = config.member_cache_size()
+        self.cache.ttl = config.member_cache_ttl()
+
+    async def resolve(self, user_id: int) -> Optional[nextcord.Member]:
+        member = self.guild().get_member(user_id)
+        if member is not None:
+            self.gateway_hits.increment()
+            return member
+
+        found, member = self.cache.lookup(user_id)
+        if found:
+            return member
+
+        if user_id in self.requests:
+            self.shared_requests.increment()
+        return await self.requests.run(user_id, lambda: self.__fetch__(user_id))
+
+    async def __fetch__(self, user_id: int) -> Optional[nextcord.Member]:
+        self.rest_requests.increment()
+
+        try:
+            member = await self.guild().fetch_member(user_id)
+        except nextcord.NotFound:
+            self.cache.store(user_id, None, self.config.member_cache_negative_ttl())
+            return None
+
+        self.cache.store(user_id, member)
+        return member
+
+
 class Discord:
-    def __init__(self, bot: Bot, config: files.Discord, db: database.MySQL):
+    def __init__(self, bot: Bot, config: files.Discord, db: database.AsyncDatabase):
         self.config = config
         self.bot = bot
         self.database = db
 
-        self.roles: Optional[dict[str, nextcord.Role]] = None
-        self.premium_role: Optional[nextcord.Role] = None
+        self.registry = RoleRegistry(config)
+        self.members = MemberResolver(config, self.get_guild)
         self.ready = False
 
+        # PATCH /guilds/{guild}/members/{member} shares one rate limit bucket per guild
+        self.edit_bucket = TokenBucket(config.role_edit_rate(), config.role_edit_burst())
+
+        # discord ids whose roles might be outdated, filled by database writes and gateway events
+        self.dirty: Set[int] = set()
+        # mark_dirty is called on the database worker threads while the sweep swaps the set on the event loop
+        self.dirty_lock = threading.Lock()
+        self.database.add_change_listener(self.mark_dirty)
+
+        # members with a scheduled, event driven update
+        self.pending_updates: dict[int, asyncio.Task] = {}
+
     async def fetch(self) -> None:
         log.info("Fetching Discord instances...")
+        self.ready = self.__load_roles__()
 
-        if not self.get_guild():
+    def __load_roles__(self) -> bool:
+        guild = self.get_guild()
+        if not guild:
             log.error("Could not fetch guild. Please check the discord section in your config!")
-            return
+            return False
 
-        self.roles, self.premium_role = await self.__fetch_roles__()
-        if len(self.roles) == 0:
+        # the gateway cache is kept up to date by the role events, see cogs/updater.py
+        self.registry.rebuild(guild)
+        if len(self.registry.roles) == 0:
             log.error("Could not fetch functional roles. Please check the discord section in your config!")
-            return
+            return False
 
         if not self.premium_role:
             log.error("Could not fetch premium role. Please check the discord section in your config!")
-            return
+            return False
 
         if not self.all_roles_present():
             log.error("Could not fetch every functional role. "
                       "Please check your discord accordingly to your configurations.")
-            return
+            return False
+
+        return True
 
-        self.ready = True
+    def reload(self, config: files.Discord) -> None:
+        previous = self.config
+        self.config = config
+        self.registry.config = config
+        self.members.reload(config)
+
+        self.edit_bucket.rate = config.role_edit_rate()
+        self.edit_bucket.capacity = config.role_edit_burst()
+
+        # resolved members stay valid, only the role registry depends on the role mapping
+        if roles_changed(previous, config) and self.bot.is_ready():
+            self.ready = self.__load_roles__()
 
     def get_guild(self) -> nextcord.Guild:
         return self.bot.get_guild(self.config.guild_id())
 
     def is_ready(self):
-        return self.ready and self.all_roles_present()
+        return self.ready and self.premium_role is not None and self.all_roles_present()
 
     def all_roles_present(self) -> bool:
         for rid in self.config.resource_ids():
@@ -61,27 +188,15 @@ class Discord:
                 return False
         return True
 
-    async def __fetch_roles__(self) -> Tuple[dict[str, nextcord.Role], nextcord.Role]:
-        roles = dict()
-        premium_role = None
-
-        guild = self.get_guild()
-        fetched = await guild.fetch_roles()
-
-        for role in fetched:
-            if role.id == self.config.premium_role():
-                premium_role = role
-            else:
-                rid = self.config.rid_by_role(role.id)
-                if rid is not None:
-                    roles[str(rid)] = role
-        return roles, premium_role
+    @property
+    def premium_role(self) -> Optional[nextcord.Role]:
+        return self.registry.premium_role
 
     def get_role(self, rid: int) -> Optional[nextcord.Role]:
-        return self.roles.get(str(rid))
+        return self.registry.get_role(rid)
 
-    async def fetch_member(self, user_id: int) -> nextcord.Member:
-        return await self.get_guild().fetch_member(user_id)
+    async def fetch_member(self, user_id: int) -> Optional[nextcord.Member]:
+        return await self.members.resolve(user_id)
 
     def get_member(self, user_id: int) -> nextcord.Member:
         return self.get_guild().get_member(user_id)
@@ -95,60 +210,160 @@ class Discord:
     def get_admin_channel(self) -> nextcord.TextChannel:
         return self.get_guild().get_channel(self.config.admin_channel())
 
-    async def update_members(self) -> int:
-        changed = 0
+    async def update_members(self) -> "ReconciliationReport":
+        # linked buyers without any role yet are only known through the dirty set
+        members: dict[int, nextcord.Member] = {m.id: m for m in self.__take_dirty_members__()}
+
+        for role in self.registry.roles.values():
+            members.update((m.id, m) for m in role.members)
+        if self.premium_role:
+            members.update((m.id, m) for m in self.premium_role.members)
 
-        roles, premium_role = await self.__fetch_roles__()
-        members: Set[nextcord.Member] = set()
+        return await self.reconcile(members.values())
 
-        for role in roles.values():
-            members.update(role.members)
-        members.update(premium_role.members)
+    def mark_dirty(self, user_ids: Iterable[int]) -> None:
+        with self.dirty_lock:
+            self.dirty.update(user_ids)
 
-        for m in members:
-            if await self.update_member(m):
-                changed += 1
+    async def update_dirty_members(self) -> "ReconciliationReport":
+        return await self.reconcile(self.__take_dirty_members__())
 
-        return changed
+    def __take_dirty_members__(self) -> list[nextcord.Member]:
+        with self.dirty_lock:
+            user_ids = self.dirty
+            self.dirty = set()
+
+        guild = self.get_guild()
+        # users who are not on the guild (anymore) have no roles to update
+        return [m for m in map(guild.get_member, user_ids) if m is not None]
+
+    def request_update(self, user_id: int) -> None:
+        if not self.is_ready() or user_id in self.pending_updates:
+            # bursts of events for the same member are handled by the already scheduled update
+            return
+
+        self.pending_updates[user_id] = asyncio.create_task(self.__delayed_update__(user_id))
+
+    async def __delayed_update__(self, user_id: int) -> None:
+        try:
+            await asyncio.sleep(self.config.event_delay())
+        finally:
+            self.pending_updates.pop(user_id, None)
+
+        member = self.get_member(user_id)
+        if member is None:
+            return
+
+        try:
+            await self.update_member(member)
+        except nextcord.HTTPException as e:
+            log.warning(f"Could not update the roles of '{member}' ({member.id}):", e)
+
+    async def reconcile(self, members: Iterable[nextcord.Member]) -> "ReconciliationReport":
+        members = list(members)
+        report = ReconciliationReport(len(members))
+        if len(members) == 0:
+            return report
+
+        entitlements = await self.database.get_bought_rids_bulk(m.id for m in members)
+        slots = asyncio.Semaphore(self.config.reconciliation_concurrency())
+        last_progress = time.monotonic()
+
+        async def update(member: nextcord.Member) -> None:
+            nonlocal last_progress
+
+            async with slots:
+                start = time.perf_counter()
+                try:
+                    if await self.update_member(member, entitlements.get(member.id, [])):
+                        report.changed += 1
+                except nextcord.HTTPException as e:
+                    report.failed += 1
+                    log.warning(f"Could not update the roles of '{member}' ({member.id}):", e)
+                finally:
+                    report.latency.record(time.perf_counter() - start)
+                    report.processed += 1
+
+            if time.monotonic() - last_progress >= 15:
+                last_progress = time.monotonic()
+                log.info(f"Reconciliation progress: {report.processed}/{report.total} member(s).")
+
+        await asyncio.gather(*[update(m) for m in members])
+        report.finish()
+        return report
 
     async def update_user(self, user_id: int) -> None:
-        await self.update_member(await self.fetch_member(user_id))
-
-    async def update_member(self, member: nextcord.Member) -> bool:
-        rids = self.database.get_bought_rids(member.id)
-        updated = False
-
-        if len(rids) > 0:
-            if self.premium_role not in member.roles:
-                log.info(f"Adding premium role to '{member}' ({member.id}) due to {len(rids)} verified purchase(s).")
-                await member.add_roles(
-                    self.premium_role,
-                    reason=f"Role added by {len(rids)} verified purchase(s)."
-                )
-                updated = True
-        else:
-            if self.premium_role in member.roles:
-                log.info(f"Removing premium role from '{member}' ({member.id}) due to 0 verified purchases.")
-                await member.remove_roles(
-                    self.premium_role,
-                    reason=f"Role removed due to 0 verified purchases."
-                )
-                updated = True
-
-        for role in member.roles:
-            rid = self.config.rid_by_role(role.id)
-            if rid is not None and rid not in rids:
-                # illegal role access
-                log.info(f"Removing role '{role.name}' from '{member}' ({member.id}) "
-                         f"due to insufficient purchase access ({rid}).")
-                await member.remove_roles(role, reason=f"Role removed due to insufficient purchase access ({rid}).")
-                updated = True
+        member = await self.fetch_member(user_id)
+        if member is not None:
+            await self.update_member(member)
+
+    async def update_member(self, member: nextcord.Member, rids: Optional[list[int]] = None) -> "RoleDiff":
+        if rids is None:
+            rids = await self.database.get_bought_rids(member.id)
+
+        diff = self.compute_role_diff(member, rids)
+        if not diff:
+            return diff
+
+        log.info(f"Updating roles of '{member}' ({member.id}) due to {len(rids)} verified purchase(s): {diff}")
+
+        roles = [r for r in member.roles if not r.is_default() and r not in diff.removed] + diff.added
+        await self.edit_bucket.acquire()
+        await member.edit(roles=roles, reason=f"Roles synchronized with {len(rids)} verified purchase(s).")
+        return diff
+
+    def compute_role_diff(self, member: nextcord.Member, rids: list[int]) -> "RoleDiff":
+        desired: Set[nextcord.Role] = set()
+
+        # the role may be deleted while a sweep is running
+        premium_role = self.premium_role
+        if len(rids) > 0 and premium_role is not None:
+            desired.add(premium_role)
 
         for rid in rids:
             role = self.get_role(rid)
-            if role and role not in member.roles:
-                log.info(f"Adding role '{role.name}' to '{member}' ({member.id}) due to a verified purchase ({rid}).")
-                await member.add_roles(role, reason=f"Role added by verified purchase ({rid}).")
-                updated = True
+            if role:
+                desired.add(role)
+
+        added = [r for r in desired if r not in member.roles]
+        removed = [r for r in member.roles if self.is_managed_role(r) and r not in desired]
+        return RoleDiff(added, removed)
+
+    def is_managed_role(self, role: nextcord.Role) -> bool:
+        return self.registry.is_managed(role)
+
+
+class RoleDiff:
+    __slots__ = ("added", "removed")
+
+    def __init__(self, added: list[nextcord.Role], removed: list[nextcord.Role]):
+        self.added = added
+        self.removed = removed
+
+    def __bool__(self) -> bool:
+        return len(self.added) > 0 or len(self.removed) > 0
+
+    def __str__(self) -> str:
+        added = ", ".join(r.name for r in self.added)
+        removed = ", ".join(r.name for r in self.removed)
+        return f"added [{added}], removed [{removed}]"
+
+
+class ReconciliationReport:
+    def __init__(self, total: int):
+        self.total = total
+        self.processed = 0
+        self.changed = 0
+        self.failed = 0
+        self.latency = metrics.Latency("reconciliation.member")
+        self.started = time.perf_counter()
+        self.duration = 0.0
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self.started
+        metrics.latency("reconciliation.run").record(self.duration)
 
-        return updated
+    def __str__(self) -> str:
+        return f"{self.changed} of {self.total} member(s) changed, {self.failed} failed in {self.duration:.1f}s " \
+               f"(per member: p50={self.latency.percentile(50) * 1000:.0f}ms, " \
+               f"p95={self.latency.percentile(95) * 1000:.0f}ms, p99={self.latency.percentile(99) * 1000:.0f}ms)"
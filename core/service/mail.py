@@ -1,15 +1,35 @@
-import email
+import asyncio
+import base64
 import imaplib
+import quopri
+import re
+import select
 import smtplib
 import ssl
-from datetime import datetime
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from email import policy
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Optional
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr, parsedate_to_datetime
+from typing import Optional, Iterator, Union, Any
 
 import nextcord
 
 from core import files, log, magic
+from core.service import database
+
+SPIGOT_SENDER = "forums@spigotmc.org"
+FETCH_CHUNK_SIZE = 25
+# mails which are looked at when there is no valid uid to continue from
+INITIAL_SYNC_WINDOW = timedelta(days=1)
+
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)]"
+# parentheses, quoted strings, literal markers and atoms like BODY[HEADER.FIELDS (FROM)] of a fetch response
+FETCH_TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{\d+}$|([^\s()"\[]*\[[^\]]*][^\s()"]*|[^\s()"]+))')
 
 
 def __valid_str__(text: str) -> bool:
@@ -43,9 +63,132 @@ def __get_message__(body: str) -> Optional[str]:
     return body[message_from:message_to]
 
 
+def __is_verification_mail__(sender: str, subject: str) -> bool:
+    if parseaddr(sender)[1].lower() != SPIGOT_SENDER:
+        return False
+
+    return "started a conversation with you" in subject \
+           or "New reply to your conversation" in subject
+
+
+def __parse_date__(date_info: str) -> datetime:
+    # handles every RFC 2822 date, including trailing comments like '(CEST)'
+    date = parsedate_to_datetime(date_info)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.astimezone().replace(tzinfo=None)
+
+
+def __tokenize__(data: list) -> Iterator[Union[str, bytes, None]]:
+    for item in data:
+        line, literal = item if isinstance(item, tuple) else (item, None)
+
+        position = 0
+        while position < len(line):
+            match = FETCH_TOKEN.match(line, position)
+            if match is None or match.end() == position:
+                break
+            position = match.end()
+
+            opening, closing, quoted, atom = match.groups()
+            if opening:
+                yield "("
+            elif closing:
+                yield ")"
+            elif quoted is not None:
+                yield re.sub(rb"\\(.)", rb"\1", quoted)
+            elif atom is not None:
+                yield None if atom.upper() == b"NIL" else atom
+
+        if literal is not None:
+            yield literal
+
+
+def __parse_fetch__(data: list) -> list[dict[str, Any]]:
+    # turns the data of a fetch command into one dict of fetched items per message
+    stack: list[list] = [[]]
+    for token in __tokenize__(data):
+        if token == "(":
+            stack.append([])
+        elif token == ")" and len(stack) > 1:
+            values = stack.pop()
+            stack[-1].append(values)
+        elif token != ")":
+            stack[-1].append(token)
+
+    messages = []
+    for values in stack[0]:
+        if isinstance(values, list):
+            messages.append({values[i].decode().upper(): values[i + 1] for i in range(0, len(values) - 1, 2)
+                             if isinstance(values[i], bytes)})
+    return messages
+
+
+def __find_plain_part__(structure: list, section: str = "") -> Optional[tuple[str, str, str]]:
+    # returns the section, transfer encoding and charset of the first text/plain part of a BODYSTRUCTURE
+    if len(structure) > 0 and isinstance(structure[0], list):
+        for i, part in enumerate(structure):
+            if not isinstance(part, list):
+                # the subtype of the multipart ends its list of parts
+                break
+
+            found = __find_plain_part__(part, f"{section}{i + 1}.")
+            if found is not None:
+                return found
+        return None
+
+    if len(structure) < 7 or not isinstance(structure[0], bytes) or not isinstance(structure[1], bytes):
+        return None
+    if structure[0].lower() != b"text" or structure[1].lower() != b"plain":
+        return None
+
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition[0] is not None and disposition[0].lower() == b"attachment":
+        return None
+
+    charset = "utf-8"
+    parameters = structure[2] if isinstance(structure[2], list) else []
+    for i in range(0, len(parameters) - 1, 2):
+        if parameters[i].lower() == b"charset" and parameters[i + 1] is not None:
+            charset = parameters[i + 1].decode()
+
+    encoding = (structure[5] or b"7bit").decode().lower()
+    return (section[:-1] if section else "1"), encoding, charset
+
+
+def __decode_body__(payload: bytes, encoding: str, charset: str) -> str:
+    if encoding == "base64":
+        payload = base64.b64decode(payload)
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+
+    try:
+        body = payload.decode(charset, errors="replace")
+    except LookupError:
+        body = payload.decode("utf-8", errors="replace")
+    return body.replace("\r\n", "\n")
+
+
+def __has_buffered_data__(imap: imaplib.IMAP4) -> bool:
+    # select() only sees the socket, not what ssl or imaplib's reader already took from it
+    sock = imap.sock
+    if isinstance(sock, ssl.SSLSocket) and sock.pending() > 0:
+        return True
+
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return len(imap.file.peek(1)) > 0
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
 class MailService:
-    def __init__(self, config: files.EmailService):
+    def __init__(self, config: files.EmailService, db: database.Database):
         self.config = config
+        self.database = db
 
         if not self.__has_valid_credentials__():
             log.error("Some of the mail service credentials are not valid! Please double check.")
@@ -58,6 +201,8 @@ class MailService:
         if not __valid_str__(self.email_html):
             log.error("Cannot find a valid 'email.html' file in the root directory. Please check!")
 
+        self.watcher = MailboxWatcher(self)
+
     def is_ready(self) -> bool:
         return self.__has_valid_credentials__() \
                and __valid_str__(self.email_plain) \
@@ -108,72 +253,249 @@ class MailService:
         )
         return html, plain
 
-    def got_received_promotion_keys(self) -> dict[str, tuple[str, datetime]]:
+    def fetch_new_promotion_keys(self, imap: imaplib.IMAP4, last_uid: Optional[int]) \
+            -> tuple[dict[str, tuple[str, datetime]], int]:
+        # returns the new verification mails and the highest uid they have been searched up to
+        if last_uid is not None:
+            criteria = ("UID", f"{last_uid + 1}:*")
+        else:
+            # uids of another mailbox generation are meaningless, start over with the recent mails
+            since = datetime.now() - INITIAL_SYNC_WINDOW
+            criteria = ("SINCE", since.strftime("%d-%b-%Y"))
+            last_uid = 0
+
+        status, data = imap.uid("SEARCH", None, *criteria, "FROM", f'"{SPIGOT_SENDER}"')
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"Could not search the inbox: {data}")
+
+        # 'n:*' always matches the newest mail, even if its uid is lower than n
+        uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+
         inbox = {}
+        for i in range(0, len(uids), FETCH_CHUNK_SIZE):
+            for name, message, date in self.__fetch_promotion_keys__(imap, uids[i:i + FETCH_CHUNK_SIZE]):
+                inbox[name] = (message, date)
 
-        for mail in self.__fetch_multipart_mails__(2):
-            sender, subject, date, body = mail
+        # the uid is only stored once the mails have been handled, see MailboxWatcher.confirm()
+        return inbox, uids[-1] if len(uids) > 0 else last_uid
 
-            if sender != "Spigot Forums <forums@spigotmc.org>":
-                continue
+    def __fetch_promotion_keys__(self, imap: imaplib.IMAP4, uids: list[int]) -> list[tuple[str, str, datetime]]:
+        # first phase: headers and structure only, which is enough to skip every unrelated mail
+        status, data = imap.uid("FETCH", ",".join(map(str, uids)), f"(UID BODYSTRUCTURE {HEADER_FIELDS})")
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"Could not fetch mail headers: {data}")
 
-            if "started a conversation with you" not in subject \
-                    and "New reply to your conversation" not in subject:
+        candidates: dict[str, list[tuple[int, datetime, str, str]]] = {}
+        for item in __parse_fetch__(data):
+            header = next((v for k, v in item.items() if k.startswith("BODY[HEADER")), None)
+            if "UID" not in item or not isinstance(header, bytes) or not isinstance(item.get("BODYSTRUCTURE"), list):
                 continue
 
-            name = __get_name__(body)
-            if name is None:
+            headers = BytesHeaderParser(policy=policy.default).parsebytes(header)
+            if not __is_verification_mail__(str(headers.get("From", "")), str(headers.get("Subject", ""))):
                 continue
 
-            message = __get_message__(body)
-            if message is None:
+            part = __find_plain_part__(item["BODYSTRUCTURE"])
+            if part is None or headers.get("Date") is None:
                 continue
 
-            inbox[name.lower()] = (message, date)
-        return inbox
-
-    def __fetch_multipart_mails__(self, mail_count: int) \
-            -> list[tuple[str, str, datetime, str]]:
-        imap = imaplib.IMAP4_SSL(self.config.host())
-        imap.login(self.config.email(), self.config.password())
-        status, messages = imap.select("INBOX")
+            try:
+                date = __parse_date__(str(headers["Date"]))
+            except (TypeError, ValueError):
+                log.warning(f"Skipping a verification mail with an invalid date: {headers['Date']}")
+                continue
 
-        if status != "OK":
-            return []
-
-        inbox = []
-        messages = int(messages[0])
-        mail_count = min(messages, mail_count)
-        for i in range(messages - mail_count + 1, messages + 1, 1):
-            res, msg = imap.fetch(str(i), "(RFC822)")
-
-            for response in msg:
-                if isinstance(response, tuple):
-                    message = email.message_from_bytes(response[1])
-
-                    sender = message.get("From")
-                    subject = message["Subject"]
-
-                    date_info: str = message["Date"]
-
-                    # date info sometimes contains a '(CEST)'
-                    idx = date_info.rfind(" (")
-                    if idx != -1:
-                        date_info = date_info[:idx]
-
-                    try:
-                        date = datetime.strptime(date_info, "%a, %d %b %Y %H:%M:%S %z").astimezone().replace(tzinfo=None)
-                    except ValueError:
-                        date = datetime.strptime(date_info, "%a, %d %b %Y %H:%M:%S %Z").astimezone().replace(tzinfo=None)
-
-                    if message.is_multipart():
-                        for part in message.walk():
-                            content_type = part.get_content_type()
-                            content_disposition = str(part.get("Content-Disposition"))
-
-                            if content_type == "text/plain" and "attachment" not in content_disposition:
-                                body = part.get_payload(decode=True).decode()
-                                inbox.append((sender, subject, date, body))
-        imap.close()
-        imap.logout()
-        return inbox
+            section, encoding, charset = part
+            candidates.setdefault(section, []).append((int(item["UID"]), date, encoding, charset))
+
+        # second phase: only the text/plain part of the verification mails
+        promotion_keys = []
+        for section, mails in candidates.items():
+            status, data = imap.uid("FETCH", ",".join(str(mail[0]) for mail in mails), f"(UID BODY.PEEK[{section}])")
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"Could not fetch mail bodies: {data}")
+
+            bodies = {int(item["UID"]): item.get(f"BODY[{section}]") for item in __parse_fetch__(data) if "UID" in item}
+            for uid, date, encoding, charset in mails:
+                payload = bodies.get(uid)
+                if not isinstance(payload, bytes):
+                    continue
+
+                body = __decode_body__(payload, encoding, charset)
+                name = __get_name__(body)
+                message = __get_message__(body)
+                if name is not None and message is not None:
+                    promotion_keys.append((uid, name.lower(), message, date))
+
+        # newer mails of the same user replace older ones
+        return [(name, message, date) for _, name, message, date in sorted(promotion_keys)]
+
+
+class MailDelta:
+    __slots__ = ("mails", "uid_validity", "last_uid", "confirmed")
+
+    def __init__(self, mails: dict[str, tuple[str, datetime]], uid_validity: int, last_uid: int):
+        # lowercase spigot name -> newest verification message and its date
+        self.mails = mails
+        self.uid_validity = uid_validity
+        self.last_uid = last_uid
+        self.confirmed = False
+
+
+class MailboxWatcher:
+    def __init__(self, service: MailService):
+        self.service = service
+
+        self.imap: Optional[imaplib.IMAP4] = None
+        self.uid_validity = 0
+        # uid validity and uid the inbox has been searched up to, ahead of the stored one until deltas are confirmed
+        self.position: Optional[tuple[int, Optional[int]]] = None
+
+        # newly arrived verification mails of every sync, consumed by the promotion cog
+        self.deltas: asyncio.Queue[MailDelta] = asyncio.Queue()
+        # deltas in the order they were synced, the stored uid never passes the oldest unconfirmed one
+        self.unconfirmed: list[MailDelta] = []
+        self.stopped = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.stopped.clear()
+            self.task = asyncio.create_task(self.__run__())
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+        self.__disconnect__()
+
+    async def __run__(self) -> None:
+        delay = 1.0
+
+        try:
+            while not self.stopped.is_set():
+                try:
+                    # every blocking imap call runs in a worker thread, never more than one at a time
+                    delta = await asyncio.to_thread(self.__sync__)
+                    self.unconfirmed.append(delta)
+                    if len(delta.mails) > 0:
+                        self.deltas.put_nowait(delta)
+                    else:
+                        self.confirm(delta)
+
+                    delay = 1.0
+                    await asyncio.to_thread(self.__wait_for_changes__)
+                    continue
+                except (imaplib.IMAP4.error, OSError) as e:
+                    log.warning(f"Lost the IMAP session, reconnecting in {delay:.0f}s:", e)
+                except Exception as e:
+                    log.error(f"Got an error while syncing the inbox, reconnecting in {delay:.0f}s:", e,
+                              f"\n{traceback.format_exc()}")
+
+                await asyncio.to_thread(self.__disconnect__)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.service.config.max_reconnect_delay())
+        finally:
+            # lets an IDLE which is still running in the worker thread return
+            self.stopped.set()
+
+    def confirm(self, delta: MailDelta) -> None:
+        # called once the mails of a delta have been handled, stores how far the inbox has been processed
+        delta.confirmed = True
+
+        stored = None
+        while len(self.unconfirmed) > 0 and self.unconfirmed[0].confirmed:
+            stored = self.unconfirmed.pop(0)
+
+        if stored is not None:
+            self.service.database.set_last_mail_uid(stored.uid_validity, stored.last_uid)
+
+    def __sync__(self) -> MailDelta:
+        if self.imap is None:
+            self.__connect__()
+
+        if self.position is None or self.position[0] != self.uid_validity:
+            uid_validity, last_uid = self.service.database.get_last_mail_uid()
+            self.position = (self.uid_validity, last_uid if uid_validity == self.uid_validity else None)
+
+        mails, last_uid = self.service.fetch_new_promotion_keys(self.imap, self.position[1])
+        self.position = (self.uid_validity, last_uid)
+        return MailDelta(mails, self.uid_validity, last_uid)
+
+    def __connect__(self) -> None:
+        config = self.service.config
+        # a silently dead connection fails with a timeout instead of hanging until tcp gives up
+        imap = imaplib.IMAP4_SSL(config.host(), timeout=config.socket_timeout())
+
+        try:
+            imap.login(config.email(), config.password())
+            status, _ = imap.select("INBOX")
+            if status != "OK":
+                raise imaplib.IMAP4.error("Could not select the inbox.")
+
+            _, data = imap.response("UIDVALIDITY")
+            uid_validity = int(data[0])
+        except Exception:
+            imap.shutdown()
+            raise
+
+        self.imap = imap
+        self.uid_validity = uid_validity
+
+    def __disconnect__(self) -> None:
+        imap, self.imap = self.imap, None
+        if imap is None:
+            return
+
+        try:
+            imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            imap.shutdown()
+
+    def __wait_for_changes__(self) -> bool:
+        config = self.service.config
+
+        if "IDLE" in self.imap.capabilities:
+            # servers drop idling clients after 30 minutes, so IDLE is restarted regularly
+            return self.__idle__(config.idle_timeout())
+
+        self.stopped.wait(config.poll_interval())
+        if self.stopped.is_set():
+            return False
+
+        self.imap.noop()
+        return True
+
+    def __idle__(self, timeout: float) -> bool:
+        # imaplib has no IDLE support before python 3.14, see RFC 2177
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.send(tag + b" IDLE\r\n")
+
+        response = imap.readline()
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"The server rejected IDLE: {response!r}")
+
+        changed = False
+        deadline = time.monotonic() + timeout
+        while not changed and not self.stopped.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # short slices to notice a stop request
+            if __has_buffered_data__(imap) or select.select([imap.sock], [], [], min(remaining, 1))[0]:
+                line = imap.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("The server closed the connection during IDLE.")
+                changed = line.startswith(b"* ") and line.rstrip().endswith(b" EXISTS")
+
+        imap.send(b"DONE\r\n")
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("The server closed the connection during IDLE.")
+            if line.startswith(tag):
+                break
+
+        return changed
@@ -1,9 +1,13 @@
+import asyncio
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple, List
 
 import requests
 
 from core import log, magic
+from core.cache import SingleFlight
 from core.service import database
 
 time_format = "%Y-%m-%dT%H:%M:%SZ"
@@ -123,23 +127,40 @@ def __get_tax__(transaction: dict) -> Optional[float]:
 
 
 class ApiReader:
-    def __init__(self, db: database.MySQL, client_id: str, secret: str, url: str = "https://api-m.paypal.com"):
+    def __init__(self, db: database.Database, client_id: str, secret: str, url: str = "https://api-m.paypal.com"):
         self.db = db
         self.client_id = client_id
         self.secret = secret
         self.url = url
         self.access_token = None
 
+        # serializes syncs of the scheduler and the promotion cog
+        self.lock = threading.Lock()
+        self.refreshed_at: Optional[float] = None
+        self.refreshing: SingleFlight[str, None] = SingleFlight()
+
     def fetch_access_token(self) -> None:
         self.access_token = self.__fetch_access_token__()
 
         if self.access_token is None:
             log.error("Could not fetch PayPal access token! Please check your credentials.")
 
+    async def refresh(self, max_age: float = magic.PAYPAL_UPDATE_DELAY) -> None:
+        # skips fresh data and lets concurrent callers share a single sync
+        if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < max_age:
+            return
+
+        await self.refreshing.run("transactions", lambda: asyncio.to_thread(self.update_transaction_data, True, 0))
+
     def update_transaction_data(self, silent: bool = False, fetch_buffer: int = magic.PAYPAL_UPDATE_DELAY) -> None:
+        with self.lock:
+            self.__update_transaction_data__(silent, fetch_buffer)
+
+    def __update_transaction_data__(self, silent: bool, fetch_buffer: int) -> None:
         if self.access_token is None:
             return
 
+        started = time.monotonic()
         last_fetch = self.db.get_latest_paypal_transaction_date()
 
         if fetch_buffer > 0:
@@ -149,21 +170,31 @@ class ApiReader:
 
         now = datetime.now()
         now_s = time_to_string__(now)
-        __ensure_date_limit__(
-            last_fetch,
-            now,
-            lambda start, end: self.__save_payments__(start, end, silent=silent)
-        )
+        counts = [0, 0]
+
+        def save(start: datetime, end: datetime) -> None:
+            inserted, duplicates = self.__save_payments__(start, end, silent=silent)
+            counts[0] += inserted
+            counts[1] += duplicates
+
+        __ensure_date_limit__(last_fetch, now, save)
         self.db.set_last_paypal_fetch(now_s)
+        self.refreshed_at = started
 
-    def __save_payments__(self, date_start: datetime, date_end: datetime, silent: bool = False) -> None:
+        if not silent or counts[0] > 0:
+            log.info(f"Stored {counts[0]} new PayPal payment(s), {counts[1]} were already known.")
+
+    def __save_payments__(self, date_start: datetime, date_end: datetime, silent: bool = False) -> Tuple[int, int]:
+        payments: List[database.Payment] = []
         for transaction in self.__fetch_transactions__(date_start, date_end, silent=silent):
             data = get_data_from_payment(transaction)
             if data is None:
                 continue
 
             rid, spigot_name, transaction_id, transaction_info, bought_at, paid, tax = data
-            self.db.add_payment(rid, spigot_name, string_to_time__(bought_at), paid, tax, "paypal")
+            payments.append((rid, spigot_name, string_to_time__(bought_at), paid, tax, "paypal"))
+
+        return self.db.add_payments(payments)
 
     def __fetch_transactions__(self, datetime_start: datetime, datetime_end: datetime, silent: bool = False) -> list[dict]:
         if self.access_token is None:
@@ -0,0 +1,145 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+import nextcord
+
+from core import files, log, magic, metrics
+from core.service import database
+
+
+class PendingPromotion:
+    __slots__ = ("user_id", "spigot_name", "name", "key", "started", "message", "admin_message")
+
+    def __init__(self, user_id: int, name: str, key: int, started: datetime, spigot_name: Optional[str] = None):
+        self.user_id = user_id
+        # like user_links, only the hashed spigot name is persisted, restored promotions don't know the plain one
+        self.name = name
+        self.spigot_name = spigot_name
+        self.key = key
+        self.started = started
+
+        # not persisted, promotions restored after a restart cannot edit their old messages
+        self.message: Optional[nextcord.WebhookMessage] = None
+        self.admin_message: Optional[nextcord.Message] = None
+
+
+class PromotionStore:
+    def __init__(self, config: files.Config, db: database.AsyncDatabase):
+        self.config = config
+        self.database = db
+
+        # discord id -> promotion, the oldest promotion first
+        self.promotions: OrderedDict[int, PendingPromotion] = OrderedDict()
+        # hashed spigot name -> promotion, the reservations new mails are matched against
+        self.names: dict[str, PendingPromotion] = {}
+        self.loaded = False
+        self.loading = asyncio.Lock()
+
+        self.expired = metrics.counter("promotions.expired")
+        self.evicted = metrics.counter("promotions.evicted")
+
+    def __len__(self) -> int:
+        return len(self.promotions)
+
+    def get(self, user_id: int) -> Optional[PendingPromotion]:
+        return self.promotions.get(user_id)
+
+    def by_name(self, spigot_name: str) -> Optional[PendingPromotion]:
+        return self.names.get(magic.encode(spigot_name))
+
+    def is_reserved(self, spigot_name: str) -> bool:
+        return magic.encode(spigot_name) in self.names
+
+    def __persist__(self) -> bool:
+        return self.config.discord().persist_pending_promotions()
+
+    def __expired_before__(self) -> datetime:
+        return datetime.now() - timedelta(seconds=self.config.discord().pending_promotion_ttl())
+
+    def __insert__(self, promotion: PendingPromotion) -> None:
+        self.promotions[promotion.user_id] = promotion
+        self.names[promotion.name] = promotion
+
+    def __discard__(self, user_id: int) -> Optional[PendingPromotion]:
+        promotion = self.promotions.pop(user_id, None)
+        if promotion is not None and self.names.get(promotion.name) is promotion:
+            self.names.pop(promotion.name)
+        return promotion
+
+    async def load(self) -> None:
+        # restores the persisted promotions once, a failed restore is tried again by the next caller
+        if self.loaded:
+            return
+
+        async with self.loading:
+            if self.loaded:
+                return
+
+            if self.__persist__():
+                await self.__restore__()
+            self.loaded = True
+
+    async def __restore__(self) -> None:
+        expired_before = self.__expired_before__()
+        await self.database.purge_expired_promotions(expired_before)
+
+        restored = 0
+        for user_id, name, key, started in await self.database.get_pending_promotions(expired_before):
+            if user_id not in self.promotions and name not in self.names:
+                self.__insert__(PendingPromotion(user_id, name, key, started))
+                restored += 1
+
+        if restored > 0:
+            # keeps the start order which expire() relies on
+            self.promotions = OrderedDict(sorted(self.promotions.items(), key=lambda item: item[1].started))
+            log.info(f"Restored {restored} pending promotion(s).")
+
+    async def add(self, user_id: int, spigot_name: str, key: int) -> PendingPromotion:
+        promotion = PendingPromotion(user_id, magic.encode(spigot_name), key, datetime.now(), spigot_name)
+        self.__discard__(user_id)
+        self.__insert__(promotion)
+
+        evicted = []
+        while len(self.promotions) > self.config.discord().max_pending_promotions():
+            evicted.append(self.__discard__(next(iter(self.promotions))))
+
+        if len(evicted) > 0:
+            self.evicted.increment(len(evicted))
+            log.warning(f"Dropped {len(evicted)} pending promotion(s) since the limit has been reached.")
+
+        if self.__persist__():
+            if len(evicted) > 0:
+                await self.database.remove_pending_promotions(p.user_id for p in evicted)
+            await self.database.add_pending_promotion(user_id, promotion.name, key, promotion.started)
+        return promotion
+
+    async def remove(self, user_id: int, expected: Optional[PendingPromotion] = None) -> Optional[PendingPromotion]:
+        # keeps a promotion the user restarted in the meantime if an older one is expected
+        if expected is not None and self.promotions.get(user_id) is not expected:
+            return None
+
+        # the promotion is gone before the first await, so it cannot be finished twice
+        promotion = self.__discard__(user_id)
+
+        if promotion is not None and self.__persist__():
+            await self.database.remove_pending_promotions([user_id])
+        return promotion
+
+    async def expire(self) -> list[PendingPromotion]:
+        expired_before = self.__expired_before__()
+
+        expired = []
+        # promotions are ordered by their start, so only the expired ones are visited
+        while len(self.promotions) > 0:
+            promotion = next(iter(self.promotions.values()))
+            if promotion.started > expired_before:
+                break
+            expired.append(self.__discard__(promotion.user_id))
+
+        if len(expired) > 0:
+            self.expired.increment(len(expired))
+            if self.__persist__():
+                await self.database.remove_pending_promotions(p.user_id for p in expired)
+        return expired
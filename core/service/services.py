@@ -1,4 +1,5 @@
-from typing import Dict
+import asyncio
+from typing import Dict, Optional, Set
 
 from nextcord.ext.commands import Bot
 
@@ -11,22 +12,58 @@ class Holder:
         self.bot = bot
         self.config = config
 
-        self.database = database.MySQL(config)
-        self.discord = discord_utils.Discord(bot, config.discord(), self.database)
-        self.mail = mail.MailService(config.email_service())
+        self.database = database.create(config)
+        self.async_database = database.AsyncDatabase(self.database, config.database())
+        self.discord = discord_utils.Discord(bot, config.discord(), self.async_database)
+        self.mail = mail.MailService(config.email_service(), self.database)
         self.paypal = paypal.ApiReader(
             self.database,
             config.paypal().client_id(),
             config.paypal().secret()
         )
 
+        self.stripe: Optional[stripe.ApiReader] = None
         if config.stripe().enabled():
-            self.stripe = stripe.ApiReader(
-                self.database,
-                config.stripe().secret(),
-                config.stripe().custom_field(),
-                config.stripe().payment_links()
-            )
+            self.stripe = self.__create_stripe__(config.stripe())
+
+        config.add_reload_listener(self.__reload__)
+
+    def __create_stripe__(self, config: files.Stripe) -> stripe.ApiReader:
+        return stripe.ApiReader(
+            self.database,
+            config.secret(),
+            config.custom_field(),
+            config.payment_links()
+        )
+
+    def __reload__(self, previous: files.Snapshot, snapshot: files.Snapshot, changed: Set[str]) -> None:
+        if "discord" in changed:
+            self.discord.reload(snapshot.discord)
+
+            activity = snapshot.discord.get_activity()
+            if activity != previous.discord.get_activity() and self.bot.is_ready():
+                asyncio.create_task(self.bot.change_presence(activity=activity))
+
+        if "email_service" in changed:
+            self.mail.config = snapshot.email_service
+
+        if "stripe" in changed:
+            if not snapshot.stripe.enabled():
+                self.stripe = None
+            elif self.stripe is None:
+                self.stripe = self.__create_stripe__(snapshot.stripe)
+            else:
+                self.stripe.reload(snapshot.stripe.secret(), snapshot.stripe.custom_field(),
+                                   snapshot.stripe.payment_links())
+
+        for section in sorted(changed.intersection(("database", "paypal"))):
+            log.warning(f"Changes to the '{section}' section of your config take effect after a restart.")
+
+    def disable_all(self) -> None:
+        log.info("Disabling services...")
+        self.mail.watcher.stop()
+        self.async_database.close()
+        self.database.close()
 
     def service_status(self) -> Dict[str, bool]:
         return {
@@ -41,21 +78,26 @@ class Holder:
 
     async def enable_all(self):
         log.info("Enabling services...")
-        # Start DB connection first
-        self.database.build_connection()
-        if not self.database.has_valid_con():
+        # everything below blocks on database or http calls, the gateway has to keep running meanwhile
+        # Start DB connection first, this runs the migrations and loads the settings and entitlements
+        await asyncio.to_thread(self.database.build_connection)
+        if not await asyncio.to_thread(self.database.has_valid_con):
             return
 
-        self.paypal.fetch_access_token()
+        await asyncio.to_thread(self.paypal.fetch_access_token)
         # Access DB for last fetch and update transaction data
-        self.paypal.update_transaction_data()
+        await asyncio.to_thread(self.paypal.update_transaction_data)
 
         if self.stripe:
-            self.stripe.update()
+            await asyncio.to_thread(self.stripe.update)
 
         # fetch all necessary roles etc.
         await self.discord.fetch()
 
+        if self.mail.is_ready():
+            # keeps a single IMAP session open to notice verification mails right away
+            self.mail.watcher.start()
+
         if self.all_services_ready():
             log.info("All services have been started successfully.")
         else:
@@ -9,7 +9,7 @@ from core.service import database
 
 
 class ApiReader:
-    def __init__(self, db: database.MySQL, secret: str, custom_field: str, payment_links: Dict,
+    def __init__(self, db: database.Database, secret: str, custom_field: str, payment_links: Dict,
                  url: str = "https://api.stripe.com"):
         self.db = db
         self.secret = secret
@@ -18,17 +18,33 @@ class ApiReader:
         self.payment_links_wrapper = None
         self.url = url
 
+    def reload(self, secret: str, custom_field: str, payment_links: Dict) -> None:
+        if secret != self.secret or payment_links != self.payment_links:
+            # resolved on the next update with the new links
+            self.payment_links_wrapper = None
+
+        self.secret = secret
+        self.custom_field = custom_field
+        self.payment_links = payment_links
+
     def update(self, silent: bool = False) -> None:
         if not silent:
             log.info(f"Fetching Stripe transaction data...")
 
         last_id = self.db.get_last_stripe_fetch()
+        payments: List[database.Payment] = []
         # must be reversed since stripe returns the most recent transactions first, and
         # the `last_id` value must be set correctly
         for checkout in reversed(self.__fetch_all_checkouts(last_id)):
-            self.add_checkout(checkout)
+            payment = self.checkout_to_payment(checkout)
+            if payment is not None:
+                payments.append(payment)
             last_id = checkout["id"]
 
+        inserted, duplicates = self.db.add_payments(payments)
+        if not silent or inserted > 0:
+            log.info(f"Stored {inserted} new Stripe payment(s), {duplicates} were already known.")
+
         if last_id:
             self.db.set_last_stripe_fetch(last_id)
 
@@ -65,7 +81,7 @@ class ApiReader:
             logging.warning(
                 "Could not fetch payment links. " + res["error"]["message"] + " " + res["error"]["request_log_url"])
 
-    def add_checkout(self, checkout: Dict) -> None:
+    def checkout_to_payment(self, checkout: Dict) -> Optional[database.Payment]:
         # ensure payment links are available
         self.__fetch_payment_links()
 
@@ -75,7 +91,7 @@ class ApiReader:
                 spigot = cf["text"]["value"]
 
         if checkout["payment_link"] not in self.payment_links_wrapper:
-            return
+            return None
 
         resource_id = self.payment_links_wrapper[checkout["payment_link"]]
         created = datetime.datetime.fromtimestamp(checkout["created"])
@@ -85,7 +101,8 @@ class ApiReader:
         tax = -checkout["payment_intent"]["latest_charge"]["balance_transaction"]["fee"] / 100.0
 
         if spigot and resource_id and created and paid and tax:
-            self.db.add_payment(resource_id, spigot, created, paid, tax, "stripe")
+            return int(resource_id), spigot, created, paid, tax, "stripe"
+        return None
 
     def __fetch_all_checkouts(self, last_id_fetched: Optional[str]) -> List:
         items, previous_page = self.__fetch_completed_checkouts(last_id_fetched)
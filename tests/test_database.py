@@ -0,0 +1,198 @@
+import datetime
+import json
+import os
+from pathlib import Path
+
+import pytest
+from mysql import connector
+
+from core import files, magic
+from core.service import database
+
+# the mysql backend is only tested against a server given through these variables, e.g. a throwaway container
+MYSQL_ENV = {"host": "TEST_MYSQL_HOST", "port": "TEST_MYSQL_PORT", "user": "TEST_MYSQL_USER",
+             "password": "TEST_MYSQL_PASSWORD", "database": "TEST_MYSQL_DATABASE"}
+TABLES = ["pending_promotions", "user_links", "user_payments", "settings"]
+BEGIN = datetime.datetime(2021, 1, 1)
+
+
+def mysql_section() -> dict:
+    return {
+        "backend": "mysql",
+        "host": os.environ[MYSQL_ENV["host"]],
+        "port": int(os.environ.get(MYSQL_ENV["port"], 3306)),
+        "user": os.environ.get(MYSQL_ENV["user"], "root"),
+        "password": os.environ.get(MYSQL_ENV["password"], ""),
+        "database": os.environ.get(MYSQL_ENV["database"], "test")
+    }
+
+
+def drop_mysql_tables(section: dict) -> None:
+    con = connector.connect(host=section["host"], port=section["port"], user=section["user"],
+                            password=section["password"], database=section["database"])
+    try:
+        cursor = con.cursor()
+        for table in TABLES:
+            cursor.execute(f"DROP TABLE IF EXISTS `{table}`;")
+        con.commit()
+    finally:
+        con.close()
+
+
+@pytest.fixture(params=[
+    "sqlite",
+    pytest.param("mysql", marks=pytest.mark.skipif(MYSQL_ENV["host"] not in os.environ,
+                                                   reason=f"{MYSQL_ENV['host']} is not set"))
+])
+def open_database(request, tmp_path, monkeypatch):
+    if request.param == "mysql":
+        section = mysql_section()
+        drop_mysql_tables(section)
+    else:
+        section = {"backend": "sqlite", "file": str(tmp_path / "bot.db")}
+
+    raw = json.loads((Path(__file__).parent.parent / "config.json").read_text())
+    raw["database"].update(section)
+    raw["database"]["settings_flush_delay"] = 0
+    (tmp_path / "config.json").write_text(json.dumps(raw))
+    monkeypatch.chdir(tmp_path)
+
+    opened = []
+
+    def open_database() -> database.Database:
+        db = database.create(files.Config())
+        db.build_connection(logging=False)
+        assert db.has_valid_con()
+        opened.append(db)
+        return db
+
+    yield open_database
+
+    for db in opened:
+        db.close()
+
+
+@pytest.fixture
+def db(open_database):
+    return open_database()
+
+
+def payment(rid: int, spigot_name: str, day: int = 1) -> database.Payment:
+    return rid, spigot_name, datetime.datetime(2024, 1, day, 12), 10.0, 0.5, "paypal"
+
+
+def test_add_payments_counts_inserted_and_duplicate_rows(db):
+    assert db.add_payments([]) == (0, 0)
+    assert db.add_payments([payment(1, "Alice"), payment(2, "Alice")]) == (2, 0)
+    # names are hashed case insensitively, so the first row is a duplicate
+    assert db.add_payments([payment(1, "alice", 2), payment(1, "Bob")]) == (1, 1)
+
+    assert db.is_premium_user("ALICE")
+    assert not db.is_premium_user("Carol")
+
+
+def test_link_and_unlink(db):
+    changed = []
+    db.add_change_listener(changed.append)
+
+    db.link_user(1, "Alice")
+    assert db.is_user_linked(1)
+    assert db.is_spigot_name_linked("alice")
+    assert db.is_spigot_name_linked(magic.encode("Alice"), do_hash=False)
+
+    db.invalidate_link(1)
+    assert not db.is_user_linked(1)
+    assert not db.is_spigot_name_linked("Alice")
+    assert changed == [{1}, {1}]
+
+    db.link_user(2, magic.encode("Bob"), do_hash=False)
+    assert db.is_spigot_name_linked("bob")
+
+
+def test_get_bought_rids(db):
+    db.add_payments([payment(1, "Alice"), payment(2, "Alice"), payment(3, "Bob")])
+    db.link_user(1, "Alice")
+    db.link_user(2, "Carol")
+
+    assert sorted(db.get_bought_rids(1)) == [1, 2]
+    assert db.get_bought_rids(2) == []
+    assert db.get_bought_rids(3) == []
+
+    # payments of already linked users reach the cached entitlements
+    db.add_payments([payment(4, "Carol")])
+    assert db.get_bought_rids(2) == [4]
+
+
+def test_get_bought_rids_bulk(db):
+    db.add_payments([payment(1, "Alice"), payment(2, "Alice"), payment(3, "Bob")])
+    db.link_user(1, "Alice")
+    db.link_user(2, "Bob")
+    db.entitlements.clear()
+
+    result = db.get_bought_rids_bulk([1, 2, 3, 1])
+    assert {user_id: sorted(rids) for user_id, rids in result.items()} == {1: [1, 2], 2: [3], 3: []}
+
+
+def test_entitlements_survive_a_restart(open_database):
+    db = open_database()
+    db.add_payments([payment(1, "Alice")])
+    db.link_user(1, "Alice")
+    db.close()
+
+    assert open_database().get_bought_rids(1) == [1]
+
+
+def test_settings_round_trip(open_database):
+    db = open_database()
+    assert db.get_last_stripe_fetch() is None
+    assert db.get_last_mail_uid() == (None, 0)
+
+    db.set_last_stripe_fetch("cs_test_1")
+    db.set_last_mail_uid(7, 42)
+    db.set_last_mail_uid(7, 43)
+    assert db.get_last_mail_uid() == (7, 43)
+    db.close()
+
+    db = open_database()
+    assert db.get_last_stripe_fetch() == "cs_test_1"
+    assert db.get_last_mail_uid() == (7, 43)
+
+
+def test_pending_promotions(db):
+    started = datetime.datetime(2024, 1, 1, 12)
+    db.add_pending_promotion(1, magic.encode("Alice"), 111111, started)
+    db.add_pending_promotion(2, magic.encode("Bob"), 222222, started + datetime.timedelta(minutes=30))
+    # restarting a promotion replaces the previous one of the user
+    db.add_pending_promotion(1, magic.encode("Carol"), 333333, started + datetime.timedelta(minutes=10))
+
+    assert db.get_pending_promotions(started) == [
+        (1, magic.encode("Carol"), 333333, started + datetime.timedelta(minutes=10)),
+        (2, magic.encode("Bob"), 222222, started + datetime.timedelta(minutes=30))
+    ]
+
+    assert [row[0] for row in db.get_pending_promotions(started + datetime.timedelta(minutes=20))] == [2]
+    assert len(db.get_pending_promotions(started)) == 2
+
+    # promotions started up to the given date have expired
+    assert db.purge_expired_promotions(started + datetime.timedelta(minutes=10)) == 1
+    assert [row[0] for row in db.get_pending_promotions(started)] == [2]
+
+    db.remove_pending_promotions([])
+    db.remove_pending_promotions([2, 3])
+    assert db.get_pending_promotions(started) == []
+
+
+def test_get_latest_paypal_transaction_date(db):
+    assert db.get_latest_paypal_transaction_date() == BEGIN
+
+    db.add_payments([payment(1, "Alice", 3), payment(2, "Bob", 5)])
+    assert db.get_latest_paypal_transaction_date() == datetime.datetime(2024, 1, 5, 12)
+
+    # paypal dates carry a time zone, they are compared against naive local dates
+    bought_at = datetime.datetime(2024, 2, 1, 8, tzinfo=datetime.timezone.utc)
+    db.add_payments([(3, "Carol", bought_at, 10.0, 0.5, "paypal")])
+
+    latest = db.get_latest_paypal_transaction_date()
+    assert latest.tzinfo is None
+    assert latest == bought_at.replace(tzinfo=None)
+    assert datetime.datetime.now() - latest > datetime.timedelta(0)
@@ -0,0 +1,61 @@
+from core.service import mail
+
+PLAIN = b'("text" "plain" ("charset" "iso-8859-1") NIL NIL "quoted-printable" 120 4 NIL NIL NIL)'
+HTML = b'("text" "html" ("charset" "utf-8") NIL NIL "base64" 300 6 NIL NIL NIL)'
+ATTACHMENT = b'("text" "plain" ("name" "key.txt") NIL NIL "base64" 20 1 NIL ("attachment" ("filename" "key.txt")) NIL)'
+
+
+def structure(body: bytes) -> list:
+    (item,) = mail.__parse_fetch__([b"1 (UID 7 BODYSTRUCTURE " + body + b")"])
+    return item["BODYSTRUCTURE"]
+
+
+def test_tokenize_keeps_literals_intact():
+    data = [(b"1 (UID 5 BODY[1] {14}", b"key (123)\r\n\"x\""), b" FLAGS (\\Seen))"]
+
+    assert list(mail.__tokenize__(data)) == [
+        b"1", "(", b"UID", b"5", b"BODY[1]", b"key (123)\r\n\"x\"", b"FLAGS", "(", b"\\Seen", ")", ")"
+    ]
+
+
+def test_tokenize_quoted_strings_and_nil():
+    data = [b'1 (BODYSTRUCTURE ("a \\"b\\"" NIL "" nil))']
+
+    assert list(mail.__tokenize__(data)) == [b"1", "(", b"BODYSTRUCTURE", "(", b'a "b"', None, b"", None, ")", ")"]
+
+
+def test_parse_fetch_of_several_messages():
+    data = [
+        (b"1 (UID 5 BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {9}", b"From: x\r\n"), b")",
+        (b"2 (UID 6 BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {9}", b"From: y\r\n"), b" FLAGS ())"
+    ]
+
+    assert mail.__parse_fetch__(data) == [
+        {"UID": b"5", "BODY[HEADER.FIELDS (FROM SUBJECT DATE)]": b"From: x\r\n"},
+        {"UID": b"6", "BODY[HEADER.FIELDS (FROM SUBJECT DATE)]": b"From: y\r\n", "FLAGS": []}
+    ]
+
+
+def test_find_plain_part_of_a_single_part_mail():
+    assert mail.__find_plain_part__(structure(PLAIN)) == ("1", "quoted-printable", "iso-8859-1")
+
+
+def test_find_plain_part_of_nested_multiparts():
+    alternative = b"(" + HTML + PLAIN + b' "alternative" ("boundary" "b2") NIL NIL)'
+    mixed = b"(" + alternative + ATTACHMENT + b' "mixed" ("boundary" "b1") NIL NIL)'
+
+    assert mail.__find_plain_part__(structure(mixed)) == ("1.2", "quoted-printable", "iso-8859-1")
+
+
+def test_find_plain_part_without_a_plain_part():
+    alternative = b"(" + HTML + HTML + b' "alternative" ("boundary" "b1") NIL NIL)'
+
+    assert mail.__find_plain_part__(structure(HTML)) is None
+    assert mail.__find_plain_part__(structure(alternative)) is None
+
+
+def test_find_plain_part_skips_attachments():
+    mixed = b"(" + HTML + ATTACHMENT + b' "mixed" ("boundary" "b1") NIL NIL)'
+
+    assert mail.__find_plain_part__(structure(ATTACHMENT)) is None
+    assert mail.__find_plain_part__(structure(mixed)) is None